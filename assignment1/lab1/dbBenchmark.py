@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# ------------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 01 December 2012
+#
+# Copyright 2012 Linkoping University
+# ------------------------------------------------------------------------------
+
+""" Benchmark of the database writes under each durability mode.
+
+    A copy of the database file is written by many threads at the same
+    time, once for every durability mode and for every way of writing:
+
+        direct  ::  each write() appends to the file on its own, under the
+                    write lock, as server.py does by default,
+        group   ::  concurrent writes are appended in batches by the group
+                    commit writer.
+
+    Every run reports the throughput (in writes per second) and latency
+    percentiles (in milliseconds) as JSON.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import tempfile
+import threading
+from optparse import OptionParser
+
+sys.path.append("../modules")
+from Server.database import Database, DURABILITY
+from Server.Lock.readWriteLock import ReadWriteLock
+
+# ------------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# ------------------------------------------------------------------------------
+
+description = """
+    Benchmark the throughput of database writes for every durability mode
+and print the results as JSON.
+"""
+
+arg_parser = OptionParser(description = description)
+arg_parser.add_option("-n", "--writes", metavar = "N", dest = "writes",
+    type = "int", default = 2000,
+    help = "Number of writes of every run.")
+arg_parser.add_option("-c", "--writers", metavar = "N", dest = "writers",
+    type = "int", default = 16,
+    help = "Number of writing threads.")
+arg_parser.add_option("-f", "--file", metavar = "FILE", dest = "file",
+    default = "dbs/fortune.db",
+    help = "Database file copied for every run.")
+arg_parser.add_option("-s", "--storage", metavar = "MODE", dest = "storage",
+    default = "list",
+    help = "Storage mode of the database: 'list' (default) or 'mmap'.")
+arg_parser.add_option("-m", "--modes", metavar = "LIST", dest = "modes",
+    default = ",".join(DURABILITY),
+    help = "Comma separated list of the durability modes to run.")
+arg_parser.add_option("-k", "--kinds", metavar = "LIST", dest = "kinds",
+    default = "direct,group",
+    help = "Comma separated list of the ways of writing to run.")
+arg_parser.add_option("-o", "--output", metavar = "FILE", dest = "output",
+    help = "Write the results to FILE instead of the standard output.")
+opts, args = arg_parser.parse_args()
+
+# ------------------------------------------------------------------------------
+# Auxiliary functions
+# ------------------------------------------------------------------------------
+
+
+def percentile(latencies, q):
+    """Return the q-th quantile of a sorted list of latencies."""
+    if not latencies:
+        return 0.0
+    return latencies[max(0, int(math.ceil(q * len(latencies))) - 1)]
+
+
+def summarize(latencies, elapsed):
+    latencies.sort()
+    return {
+        'writes': len(latencies),
+        'seconds': elapsed,
+        'writes_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def write_direct(db, rwlock, fortune):
+    rwlock.write_acquire()
+    try:
+        db.write(fortune)
+    finally:
+        rwlock.write_release()
+
+
+def write_group(db, rwlock, fortune):
+    db.write(fortune)
+
+
+def run_writes(write, db, rwlock, count, latencies):
+    for i in range(count):
+        start = time.time()
+        write(db, rwlock, "Benchmark fortune {0}.".format(i))
+        latencies.append(time.time() - start)
+
+
+def run(mode, kind, workdir):
+    db_file = os.path.join(workdir, "{0}-{1}.db".format(mode, kind))
+    shutil.copyfile(opts.file, db_file)
+    rwlock = ReadWriteLock()
+    db = Database(db_file, opts.storage, group_commit = kind == "group",
+                  lock = rwlock, durability = mode)
+    write = write_group if kind == "group" else write_direct
+
+    per_writer = [[] for _ in range(opts.writers)]
+    threads = [threading.Thread(target = run_writes,
+                                args = (write, db, rwlock,
+                                        opts.writes // opts.writers, l))
+               for l in per_writer]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = summarize(sum(per_writer, []), time.time() - start)
+    if db.writer is not None:
+        result['batches'] = db.writer.stats()['batches']
+    return result
+
+# ------------------------------------------------------------------------------
+# The main program
+# ------------------------------------------------------------------------------
+
+results = {
+    'config': {
+        'writes': opts.writes,
+        'writers': opts.writers,
+        'file': opts.file,
+        'storage': opts.storage,
+    },
+    'runs': {},
+}
+
+workdir = tempfile.mkdtemp(prefix = "dbBenchmark-")
+try:
+    for mode in opts.modes.split(","):
+        for kind in opts.kinds.split(","):
+            name = "{0}/{1}".format(mode, kind)
+            results['runs'][name] = run(mode, kind, workdir)
+finally:
+    shutil.rmtree(workdir, True)
+
+output = json.dumps(results, indent = 2, sort_keys = True)
+if opts.output is None:
+    print output
+else:
+    with open(opts.output, "w") as f:
+        f.write(output + "\n")
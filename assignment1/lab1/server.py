@@ -36,6 +36,19 @@ arg_parser.add_option("-p", "--port", metavar = "PORT", dest = "port",
            "The default value is chosen at random.")
 arg_parser.add_option("-f", "--file", metavar = "FILE", dest = "file",
     help = "Set the database file.")
+arg_parser.add_option("-s", "--storage", metavar = "MODE", dest = "storage",
+    default = "list",
+    help = "Keep the database as a 'list' of fortunes (default) or 'mmap' "
+           "it and keep only the offsets of the fortunes, which are also "
+           "saved in FILE.dat.")
+arg_parser.add_option("-g", "--group-commit", action = "store_true",
+    dest = "group_commit", default = False,
+    help = "Append concurrent writes to the database file in batches.")
+arg_parser.add_option("-d", "--durability", metavar = "MODE",
+    dest = "durability", default = "batch",
+    help = "When writes are synced to disk before being acknowledged: "
+           "'none', 'interval' (in the background, every second), 'batch' "
+           "(default; once per group commit batch) or 'write'.")
 opts, args = arg_parser.parse_args()
 
 # Initialize values for the port and database file name.
@@ -61,19 +74,24 @@ server_address = ("", port)
 class Server(object):
     """Class that provides synchronous access to the database."""
 
-    def __init__(self, db_file):
-        self.db = Database(db_file)
+    def __init__(self, db_file, storage='list', group_commit=False,
+                 durability='batch'):
         self.rwlock = ReadWriteLock()
+        self.group_commit = group_commit
+        self.db = Database(db_file, storage, group_commit=group_commit,
+                           lock=self.rwlock, durability=durability)
 
     # Public methods
 
     def read(self):
-        self.rwlock.read_acquire()
-        result = self.db.read()
-        self.rwlock.read_release()
-        return result
+        # Reads work on a snapshot of the database and take no lock.
+        return self.db.read()
 
     def write(self, fortune):
+        if self.group_commit:
+            # The database takes the lock itself once the batch is on disk.
+            self.db.write(fortune)
+            return
         self.rwlock.write_acquire()
         self.db.write(fortune)
         self.rwlock.write_release()
@@ -158,7 +176,8 @@ print "Listening to: {0}:{1}".format(socket.gethostname(), port)
 with open("srv_address.tmp", "w") as f:
     f.write("{0}:{1}\n".format(socket.gethostname(), port))
 
-sync_db = Server(db_file)
+sync_db = Server(db_file, opts.storage, opts.group_commit,
+                 opts.durability)
 
 server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 server.bind(server_address)
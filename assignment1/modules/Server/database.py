@@ -9,36 +9,514 @@
 
 """Implementation of a simple database class."""
 
+import os
+import sys
+import time
+import mmap
+import atexit
+import struct
 import random
+import threading
+import cStringIO
+from array import array
+
+# Header of strfile(1) index files: version, number of strings, length of
+# the longest and of the shortest string, flags and delimiter.
+DAT_HEADER = struct.Struct("!IIIIIc3x")
+DAT_VERSION = 2
+DAT_OFFSET_SIZE = 4
+
+# Trailer following the offsets, which strfile readers do not look at: the
+# size and modification time of the database file the index was built
+# from, and the offset up to which that file was indexed.
+DAT_TRAILER = struct.Struct("!4sQdQ")
+DAT_MAGIC = "TDDD"
+
+# When appended records are synced to disk: never, every few seconds, once
+# per batch of writes, or after every single write.
+DURABILITY = ('none', 'interval', 'batch', 'write')
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class IntervalSync(object):
+    """ Syncs a file to disk every `interval` seconds if it was written.
+
+        Writers call written() after appending to the file; the sync is
+        done by a background thread, so writes never wait for the disk. A
+        last sync is done when the interpreter exits.
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+        # Counters
+        self.syncs = 0
+        atexit.register(self.stop)
+
+    # Private methods
+
+    def _run(self):
+        while not self.stopped:
+            time.sleep(self.interval)
+            if not self.stopped:
+                self.sync()
+
+    # Public methods
+
+    def written(self):
+        self.dirty = True
+        if self.thread is None:
+            self.lock.acquire()
+            try:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run)
+                    self.thread.daemon = True
+                    self.thread.start()
+            finally:
+                self.lock.release()
+
+    def sync(self):
+        """Sync the file now if it was written since the last sync."""
+        if not self.dirty:
+            return
+        self.dirty = False
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            self.dirty = True
+            return
+        self.syncs += 1
+
+    def stop(self):
+        """Do a last sync and stop the background thread."""
+        self.stopped = True
+        self.sync()
+
+
+class _Batch(object):
+    """Records appended to the database file together."""
+
+    def __init__(self):
+        self.records = []
+        self.size = 0
+        self.done = False
+        self.error = None
+
+
+class GroupCommit(object):
+    """ Writer appending the records of concurrent callers in batches.
+
+        append() queues a record and returns once the batch holding it has
+        been written. A background thread keeps the file open and writes a
+        batch when it reaches `batch_bytes`, or `batch_delay` seconds after
+        its first record was queued, then calls `on_commit` with the records
+        of the batch. Records queued
+        while a batch is being written go into the next one, so even
+        without a delay concurrent writers share syncs.
+
+        The file is synced as `durability` says, one of DURABILITY: after
+        each batch, after each record of a batch, or not at all before
+        append() returns. In the 'interval' mode `syncer`, an IntervalSync,
+        is told about every batch written.
+    """
+
+    def __init__(self, db_file, on_commit=None, batch_bytes=64 * 1024,
+                 batch_delay=0.0, durability='batch', syncer=None):
+        self.db_file = db_file
+        self.on_commit = on_commit
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
+        self.durability = durability
+        self.syncer = syncer
+        self.cond = threading.Condition()
+        self.batch = _Batch()
+        self.file = None
+        self.thread = None
+        # Counters
+        self.batches = 0
+        self.records = 0
+
+    # Private methods
+
+    def _next_batch(self):
+        """Wait for the next batch to be ready and take it."""
+        self.cond.acquire()
+        try:
+            while not self.batch.records:
+                self.cond.wait()
+            until = time.time() + self.batch_delay
+            while self.batch.size < self.batch_bytes:
+                left = until - time.time()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            batch, self.batch = self.batch, _Batch()
+            return batch
+        finally:
+            self.cond.release()
+
+    def _write(self, batch):
+        if self.file is None:
+            self.file = open(self.db_file, 'ab')
+        try:
+            if self.durability == 'write':
+                for record in batch.records:
+                    self.file.write(record)
+                    _sync(self.file)
+            else:
+                self.file.write(''.join(batch.records))
+                if self.durability == 'batch':
+                    _sync(self.file)
+                else:
+                    self.file.flush()
+        except (IOError, OSError):
+            # Start over with a new file object on the next batch.
+            self.file.close()
+            self.file = None
+            raise
+        if self.syncer is not None:
+            self.syncer.written()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._write(batch)
+                if self.on_commit is not None:
+                    self.on_commit(batch.records)
+            except Exception, e:
+                batch.error = e
+
+            self.cond.acquire()
+            try:
+                batch.done = True
+                self.batches += 1
+                self.records += len(batch.records)
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+
+    def _start(self):
+        """Start the writer thread. Condition must be held."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Public methods
+
+    def append(self, record):
+        """Append a record and wait until its batch is written."""
+        self.cond.acquire()
+        try:
+            self._start()
+            batch = self.batch
+            batch.records.append(record)
+            batch.size += len(record)
+            self.cond.notify_all()
+            while not batch.done:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+        if batch.error is not None:
+            raise batch.error
+
+    def stats(self):
+        self.cond.acquire()
+        try:
+            return {'batches': self.batches,
+                    'records': self.records,
+                    'queued': len(self.batch.records)}
+        finally:
+            self.cond.release()
 
 
 class Database(object):
-    """Class containing a database implementation."""
+    """ Class containing a database implementation.
+
+        The database file holds fortunes separated by lines starting with
+        '%'. Two storage modes are supported:
+
+            list    ::  the fortunes are read into a list of strings,
+            mmap    ::  the file is mapped into memory and only the offsets
+                        of the fortunes are kept, so that startup does not
+                        copy the file and the pages are shared by all the
+                        processes serving it.
+
+        In the mmap mode the offsets are kept in the layout of strfile(1):
+        offsets[i] is where the i-th fortune starts and the last entry is
+        the end of the last one. Empty fortunes are skipped, as strfile
+        does. Unless `index` is False, the offsets are also saved next to
+        the database, in `db_file`.dat, in the format of strfile, so that a
+        restart loads them in one read. The sidecar is used only if it
+        matches the size and modification time of the database, and it is
+        extended in place by write().
 
-    def __init__(self, db_file):
+        write() also adds the fortune to the in-memory state. Readers see
+        that state through a snapshot that writers replace in a single
+        assignment, and the list and offsets only ever grow, so read()
+        takes no lock and never sees a write half done. Writers must not
+        run concurrently; callers serialize them with a lock.
+
+        With `group_commit`, concurrent writes are appended in batches by
+        a GroupCommit writer. `lock`, an object with write_acquire() and
+        write_release() such as the ReadWriteLock serializing the
+        writers, is then held while a batch is added to the in-memory
+        state.
+
+        `durability` is one of DURABILITY and says when write() syncs the
+        file to disk before returning: never ('none'), every
+        `sync_interval` seconds in the background ('interval'), or always
+        ('batch' and 'write'). The last two differ only with group commit,
+        where 'batch' syncs once for all the writes of a batch.
+    """
+
+    def __init__(self, db_file, storage='list', index=True,
+                 group_commit=False, batch_bytes=64 * 1024,
+                 batch_delay=0.0, lock=None, durability='batch',
+                 sync_interval=1.0):
+        if durability not in DURABILITY:
+            raise ValueError(
+                "Unknown durability mode: '{0}'".format(durability))
         self.db_file = db_file
+        self.storage = storage
+        self.lock = lock
+        self.durability = durability
         self.rand = random.Random()
         self.rand.seed()
-        self.fortunes = []
-
-        with open(db_file) as f:
-            fortune = ''
-            for line in f:
-                if line[0] == '%':
-                    self.fortunes.append(fortune)
-                    fortune = ''
-                else:
-                    fortune = ''.join([fortune, line])
+        self.syncer = None
+        if durability == 'interval':
+            self.syncer = IntervalSync(db_file, sync_interval)
+        self.writer = None
+        if group_commit:
+            self.writer = GroupCommit(db_file, self._commit_batch,
+                                      batch_bytes, batch_delay, durability,
+                                      self.syncer)
+
+        if storage == 'list':
+            self.fortunes = []
+            # Lines of a fortune not ended by a delimiter yet.
+            self.pending = []
+            with open(db_file) as f:
+                self._add_lines(f)
+
+        elif storage == 'mmap':
+            self.dat_file = db_file + ".dat" if index else None
+            self.data = ''
+            self.offsets = array('L', [0])
+            # Offset of the first byte after the last delimiter line.
+            self.indexed = 0
+            self.longlen = 0
+            self.shortlen = 0
+            # Number of offsets the sidecar holds, if it matches ours.
+            self.dat_count = None
+            self._map()
+            if self.dat_file is None or not self._load_index():
+                self._index()
+                self._save_index()
+
+        else:
+            raise ValueError("Unknown storage mode: '{0}'".format(storage))
+
+        self._publish()
+
+    # Private methods
+
+    def _add_lines(self, lines):
+        """Add the fortunes ended in the given lines to the list."""
+        pending = self.pending
+        for line in lines:
+            if line[0] == '%':
+                self.fortunes.append(''.join(pending))
+                pending = []
+            else:
+                pending.append(line)
+        self.pending = pending
+
+    def _publish(self):
+        """Make the in-memory state visible to the readers."""
+        if self.storage == 'mmap':
+            self.snapshot = (self.data, self.offsets, len(self.offsets) - 1)
+        else:
+            self.snapshot = (self.fortunes, len(self.fortunes))
+
+    def _map(self):
+        """Map the current contents of the database file."""
+        with open(self.db_file, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped.
+                self.data = ''
+
+    def _index(self):
+        """Add the offsets of the fortunes ended after self.indexed."""
+        data = self.data
+        last = self.indexed
+        if data[last:last + 1] == '%':
+            sep = last
+        else:
+            sep = data.find('\n%', max(last - 1, 0))
+            if sep >= 0:
+                sep += 1
+
+        while sep >= 0:
+            eol = data.find('\n', sep)
+            if eol < 0:
+                # A delimiter at the end of the file, without a newline.
+                eol = len(data) - 1
+            length = sep - last
+            last = eol + 1
+            if length:
+                self.offsets.append(last)
+                self.longlen = max(self.longlen, length)
+                if self.shortlen == 0 or length < self.shortlen:
+                    self.shortlen = length
+            sep = data.find('\n%', eol)
+            if sep >= 0:
+                sep += 1
+
+        self.indexed = last
+
+    def _stat(self):
+        st = os.stat(self.db_file)
+        return st.st_size, st.st_mtime
+
+    def _load_index(self):
+        """Load the offsets from the sidecar if it is up to date."""
+        try:
+            with open(self.dat_file, 'rb') as f:
+                dat = f.read()
+        except IOError:
+            return False
+
+        if len(dat) < DAT_HEADER.size:
+            return False
+        version, numstr, longlen, shortlen, _, delim = \
+            DAT_HEADER.unpack_from(dat)
+        end = DAT_HEADER.size + (numstr + 1) * DAT_OFFSET_SIZE
+        if (version != DAT_VERSION or delim != '%' or
+                len(dat) != end + DAT_TRAILER.size):
+            return False
+        magic, size, mtime, indexed = DAT_TRAILER.unpack_from(dat, end)
+        if magic != DAT_MAGIC or (size, mtime) != self._stat():
+            return False
+
+        offsets = array('I')
+        offsets.fromstring(dat[DAT_HEADER.size:end])
+        if sys.byteorder == 'little':
+            offsets.byteswap()
+        self.offsets = array('L', offsets)
+        self.indexed = indexed
+        self.longlen = longlen
+        self.shortlen = shortlen
+        self.dat_count = len(self.offsets)
+        return True
+
+    def _save_index(self):
+        """ Bring the sidecar up to date with the offsets.
+
+            Only the offsets it does not hold yet are written, unless it
+            has to be rewritten from scratch.
+        """
+        if self.dat_file is None or self.indexed >= 1 << 32:
+            return
+
+        size, mtime = self._stat()
+        header = DAT_HEADER.pack(DAT_VERSION, len(self.offsets) - 1,
+                                 self.longlen, self.shortlen, 0, '%')
+        trailer = DAT_TRAILER.pack(DAT_MAGIC, size, mtime, self.indexed)
+
+        first = self.dat_count or 0
+        offsets = array('I', self.offsets[max(first - 1, 0):])
+        if sys.byteorder == 'little':
+            offsets.byteswap()
+        try:
+            if first:
+                with open(self.dat_file, 'r+b') as f:
+                    f.seek(DAT_HEADER.size + (first - 1) * DAT_OFFSET_SIZE)
+                    f.write(offsets.tostring())
+                    f.write(trailer)
+                    f.truncate()
+                    f.seek(0)
+                    f.write(header)
+            else:
+                tmp = "{0}.{1}".format(self.dat_file, os.getpid())
+                with open(tmp, 'wb') as f:
+                    f.write(header)
+                    f.write(offsets.tostring())
+                    f.write(trailer)
+                os.rename(tmp, self.dat_file)
+        except (IOError, OSError):
+            self.dat_count = None
+            return
+        self.dat_count = len(self.offsets)
+
+    def _commit(self, records):
+        """Add the records just appended to the file to the readers' view."""
+        if self.storage == 'mmap':
+            self._map()
+            self._index()
+            self._save_index()
+        else:
+            self._add_lines(cStringIO.StringIO(''.join(records)))
+        self._publish()
+
+    def _commit_batch(self, records):
+        if self.lock is None:
+            self._commit(records)
+            return
+        self.lock.write_acquire()
+        try:
+            self._commit(records)
+        finally:
+            self.lock.write_release()
+
+    def _fortune(self, data, offsets, i):
+        """Return the i-th fortune of a mapping."""
+        start = offsets[i]
+        # Skip the delimiters of the empty fortunes before this one.
+        while data[start:start + 1] == '%':
+            start = data.find('\n', start) + 1
+        return data[start:data.find('\n%', start) + 1]
+
+    # Public methods
 
     def read(self):
         """Read a random location in the database."""
-        try:
-            return self.rand.choice(self.fortunes)
-        except IndexError:
+        if self.storage == 'mmap':
+            data, offsets, count = self.snapshot
+            if count == 0:
+                return ''
+            return self._fortune(data, offsets, self.rand.randrange(count))
+
+        fortunes, count = self.snapshot
+        if count == 0:
             return ''
+        return fortunes[self.rand.randrange(count)]
 
     def write(self, fortune):
         """Write a new fortune to the database."""
+        record = fortune + '\n%\n'
+        if self.writer is not None:
+            self.writer.append(record)
+            return
         with open(self.db_file, 'a') as f:
-            f.write(fortune)
-            f.write('\n%\n')
+            f.write(record)
+            if self.durability in ('batch', 'write'):
+                _sync(f)
+        if self.syncer is not None:
+            self.syncer.written()
+        self._commit([record])
@@ -12,11 +12,13 @@
 """Client reader/writer for a fortune database."""
 
 import sys
+import socket
 from optparse import OptionParser
 
 sys.path.append("../modules")
 from Common import orb
 from Common.nameServiceLocation import name_service_address
+from Common.nameServiceCache import NameServiceCache, default_path
 from Common.objectType import object_type
 
 # ------------------------------------------------------------------------------
@@ -37,6 +39,9 @@ arg_parser.add_option("-t", "--type", metavar = "TYPE", dest = "type",
     help = "Set the client's type.")
 arg_parser.add_option("-p", "--peer", metavar = "PEER_ID", dest = "peer_id",
     help = "The identifier of a particular server peer.")
+arg_parser.add_option("-T", "--timeout", metavar = "SECONDS", dest = "timeout",
+    type = "float", default = 30.0,
+    help = "Give up on calls that take longer than SECONDS (default 30).")
 opts, args = arg_parser.parse_args()
 
 if opts.type is None:   server_type = object_type
@@ -49,26 +54,51 @@ server_id = opts.peer_id
 # The main program
 # ------------------------------------------------------------------------------
 
-# Connect to the name service to obtain the address of the server.
-ns = orb.Stub(name_service_address)
-
-if server_id is None:
-    server_address = tuple(ns.require_any(server_type))
-else:
-    server_address = tuple(ns.require_object(server_type, int(server_id)))
-
-print "Connecting to server: {0}".format(server_address)
+# Connect to the name service to obtain the address of the server. Lookups
+# are cached in a file shared with the other clients this user runs against
+# the same name service.
+ns = NameServiceCache(orb.Stub(name_service_address, timeout = opts.timeout,
+                               idempotent = ("require_any", "require_object")),
+                      path = default_path(name_service_address))
+
+def connect():
+    """Look the server up and return a stub for it."""
+    if server_id is None:
+        address = tuple(ns.require_any(server_type))
+    else:
+        address = tuple(ns.require_object(server_type, int(server_id)))
+    print "Connecting to server: {0}".format(address)
+    return orb.Stub(address, timeout = opts.timeout, idempotent = ("read",))
+
+def read():
+    """Read a fortune, looking the server up again if it cannot be reached."""
+    global db
+    try:
+        return db.read()
+    except (socket.error, orb.ComunicationError):
+        ns.invalidate(address = db.address)
+        db = connect()
+        return db.read()
+
+def write(fortune):
+    try:
+        db.write(fortune)
+    except (socket.error, orb.ComunicationError):
+        # The write may have gone through, so it is not retried, but the
+        # next lookup should not give this server again.
+        ns.invalidate(address = db.address)
+        raise
 
 # Create the database object.
-db = orb.Stub(server_address)
+db = connect()
 
 if not opts.interactive:
     # Run in the normal mode.
     if opts.fortune is not None:
         print "Writing '{0}' to the fortune database.".format(opts.fortune)
-        db.write(opts.fortune)
+        write(opts.fortune)
     else:
-        print db.read()
+        print read()
 
 else:
     # Run in the interactive mode.
@@ -86,8 +116,8 @@ else:
         sys.stdout.write("Command> ")
         command = raw_input()
         if command == "r":
-            print db.read()
+            print read()
         elif len(command) > 1 and command[0] == "w" and command[1] in [" ", "\t"]:
-            db.write(command[2:].strip())
+            write(command[2:].strip())
         elif command == "h":
             menu()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# ------------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 01 December 2012
+#
+# Copyright 2012 Linkoping University
+# ------------------------------------------------------------------------------
+
+""" Local name service.
+
+    Stand-in for the course name service, for running and load testing the
+    labs without it. Point the peers and clients at it with
+        export TDDD25_NAME_SERVICE=<host>:<port>
+"""
+
+import sys
+import time
+import socket
+from optparse import OptionParser
+
+sys.path.append("../modules")
+from Server.nameService import NameService
+
+# ------------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# ------------------------------------------------------------------------------
+
+description = """
+    Local name service. Objects register with it and look each other up.
+"""
+
+arg_parser = OptionParser(description = description)
+arg_parser.add_option("-p", "--port", metavar = "PORT", dest = "port",
+    type = "int", default = 40000,
+    help = "Set the port to listen to. The default value is 40000.")
+arg_parser.add_option("-c", "--check", metavar = "SECONDS", dest = "check",
+    type = "float",
+    help = "Drop objects that do not answer check() every SECONDS seconds.")
+opts, args = arg_parser.parse_args()
+
+# ------------------------------------------------------------------------------
+# The main program
+# ------------------------------------------------------------------------------
+
+name_service = NameService(("", opts.port), opts.check)
+name_service.start()
+
+print "Name service listening to: {0}:{1}".format(socket.gethostname(),
+                                                  opts.port)
+print "Press Ctrl-C to stop the name service..."
+
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    pass
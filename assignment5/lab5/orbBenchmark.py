@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# ------------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# ------------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 01 December 2012
+#
+# Copyright 2012 Linkoping University
+# ------------------------------------------------------------------------------
+
+""" Micro-benchmarks for the object request broker.
+
+    A skeleton is started on the loopback interface and called through
+    orb.Stub under several workloads:
+
+        echo        ::  sequential calls with a tiny payload,
+        payload     ::  sequential calls echoing a large string,
+        concurrent  ::  many threads calling at the same time,
+        sustained   ::  calls from many threads for a fixed duration.
+
+    Every workload reports latency percentiles (in milliseconds) and the
+    throughput (in calls per second) as JSON.
+"""
+
+import sys
+import json
+import math
+import time
+import threading
+from optparse import OptionParser
+
+sys.path.append("../modules")
+from Common import log
+from Common import orb
+from Common import asyncOrb
+from Common import wire
+
+# ------------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# ------------------------------------------------------------------------------
+
+description = """
+    Benchmark the round trip of orb calls over the loopback interface and
+print the results as JSON.
+"""
+
+arg_parser = OptionParser(description = description)
+arg_parser.add_option("-n", "--calls", metavar = "N", dest = "calls",
+    type = "int", default = 5000,
+    help = "Number of calls of the echo, payload and concurrent workloads.")
+arg_parser.add_option("-c", "--callers", metavar = "N", dest = "callers",
+    type = "int", default = 16,
+    help = "Number of calling threads of the concurrent workloads.")
+arg_parser.add_option("-s", "--size", metavar = "BYTES", dest = "size",
+    type = "int", default = 64 * 1024,
+    help = "Size of the payload of the payload workload.")
+arg_parser.add_option("-d", "--duration", metavar = "SECONDS",
+    dest = "duration", type = "float", default = 5.0,
+    help = "Duration of the sustained workload.")
+arg_parser.add_option("-w", "--workloads", metavar = "LIST",
+    dest = "workloads", default = "echo,payload,concurrent,sustained",
+    help = "Comma separated list of the workloads to run.")
+arg_parser.add_option("-f", "--format", metavar = "FORMAT", dest = "format",
+    help = "Wire format of the stub: json-lines (default), json, marshal "
+           "or msgpack.")
+arg_parser.add_option("-a", "--async", action = "store_true",
+    dest = "async", default = False,
+    help = "Serve the calls with asyncOrb.AsyncSkeleton.")
+arg_parser.add_option("-t", "--transport", metavar = "TRANSPORT",
+    dest = "transport", default = "tcp",
+    help = "Transport of the stub: tcp (default), unix or inprocess.")
+arg_parser.add_option("-o", "--output", metavar = "FILE", dest = "output",
+    help = "Write the results to FILE instead of the standard output.")
+opts, args = arg_parser.parse_args()
+
+# ------------------------------------------------------------------------------
+# Auxiliary classes and functions
+# ------------------------------------------------------------------------------
+
+
+class Echo(object):
+    """Owner object of the benchmarked skeleton."""
+
+    def echo(self, data):
+        return data
+
+
+def percentile(latencies, q):
+    """Return the q-th quantile of a sorted list of latencies."""
+    if not latencies:
+        return 0.0
+    return latencies[max(0, int(math.ceil(q * len(latencies))) - 1)]
+
+
+def summarize(latencies, elapsed):
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'seconds': elapsed,
+        'calls_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'p999_ms': percentile(latencies, 0.999) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def run_calls(stub, data, count, latencies):
+    for _ in range(count):
+        start = time.time()
+        stub.echo(data)
+        latencies.append(time.time() - start)
+
+
+def run_for(stub, data, until, latencies):
+    while time.time() < until:
+        start = time.time()
+        stub.echo(data)
+        latencies.append(time.time() - start)
+
+
+def run_threads(target, args_list):
+    threads = [threading.Thread(target=target, args=args)
+               for args in args_list]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def sequential(stub, data, count):
+    latencies = []
+    # Warm up the connection before measuring.
+    stub.echo(data)
+    start = time.time()
+    run_calls(stub, data, count, latencies)
+    return summarize(latencies, time.time() - start)
+
+
+def concurrent(stub, data, count, callers):
+    per_caller = [[] for _ in range(callers)]
+    elapsed = run_threads(run_calls, [(stub, data, count // callers, l)
+                                      for l in per_caller])
+    return summarize(sum(per_caller, []), elapsed)
+
+
+def sustained(stub, data, duration, callers):
+    per_caller = [[] for _ in range(callers)]
+    until = time.time() + duration
+    elapsed = run_threads(run_for, [(stub, data, until, l)
+                                    for l in per_caller])
+    return summarize(sum(per_caller, []), elapsed)
+
+# ------------------------------------------------------------------------------
+# The main program
+# ------------------------------------------------------------------------------
+
+# Keep the per-connection records out of the measurements.
+log.configure(level = log.WARNING)
+
+# Local transports are set up when the skeleton is created.
+orb.local_transports = opts.transport != "tcp"
+
+# The stub is trusted, so every wire format is accepted.
+if opts.async:
+    skeleton = asyncOrb.AsyncSkeleton(Echo(), ("127.0.0.1", 0),
+                                      wire_formats = wire.codecs.keys())
+    address = skeleton.server.socket.getsockname()
+else:
+    skeleton = orb.Skeleton(Echo(), ("127.0.0.1", 0),
+                            wire_formats = wire.codecs.keys())
+    address = skeleton.server.getsockname()
+skeleton.start()
+
+stub = orb.Stub(address, wire_format = opts.format,
+                in_process = opts.transport == "inprocess")
+small = "x"
+large = "x" * opts.size
+
+workloads = {
+    'echo': lambda: sequential(stub, small, opts.calls),
+    'payload': lambda: sequential(stub, large, max(1, opts.calls // 10)),
+    'concurrent': lambda: concurrent(stub, small, opts.calls, opts.callers),
+    'sustained': lambda: sustained(stub, small, opts.duration, opts.callers),
+}
+
+results = {
+    'config': {
+        'calls': opts.calls,
+        'callers': opts.callers,
+        'payload_bytes': opts.size,
+        'duration': opts.duration,
+        'skeleton': type(skeleton).__name__,
+        'wire_format': stub.wire_format,
+        'transport': opts.transport,
+    },
+    'workloads': {},
+}
+for name in opts.workloads.split(","):
+    results['workloads'][name] = workloads[name]()
+
+output = json.dumps(results, indent = 2, sort_keys = True)
+if opts.output is None:
+    print output
+else:
+    with open(opts.output, "w") as f:
+        f.write(output + "\n")
@@ -120,10 +120,12 @@ class Server(orb.Peer):
     def write_no_lock(self, fortune):
         self.db.write(fortune)
 
+    @orb.control
     def register_peer(self, pid, paddr):
         self.peer_list.register_peer(pid, paddr)
         self.distributed_lock.register_peer(pid)
 
+    @orb.control
     def unregister_peer(self, pid):
         self.peer_list.unregister_peer(pid)
         self.distributed_lock.unregister_peer(pid)
@@ -0,0 +1,395 @@
+# ------------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# ------------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 01 December 2012
+#
+# Copyright 2012 Linkoping University
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import socket
+import asyncore
+import asynchat
+import threading
+import collections
+
+from Common import log
+from Common import orb
+from Common import wire
+
+""" Event-loop based Object Request Broker
+
+    This module is an alternative to the thread-per-connection transport of
+    orb. All connections are served by one asyncore loop, so thousands of
+    idle or slow callers do not cost a thread each. Both ends speak the same
+    JSON-line protocol as orb, so they can talk to plain Stubs and
+    Skeletons. AsyncSkeleton also accepts the binary wire formats that
+    Stubs negotiate.
+
+    --  EventLoop ::
+            Thread running the asyncore loop. Other threads hand work to it
+            with call_soon().
+    --  AsyncSkeleton ::
+            Drop-in replacement for orb.Skeleton. Owner methods marked with
+            orb.nonblocking run on the loop, all others run on a
+            WorkerPool.
+    --  AsyncStub ::
+            Stub whose calls return an orb.Future instead of blocking.
+"""
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Pipe used to wake the loop up when other threads queue work."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.r, self.w = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.r, map=loop.map)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, socket.error):
+            pass
+        self.loop._run_calls()
+
+    def wake(self):
+        os.write(self.w, 'x')
+
+
+class EventLoop(threading.Thread):
+    """Thread running an asyncore loop over its own socket map."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.map = {}
+        self.calls = collections.deque()
+        self.waker = _Waker(self)
+        self.daemon = True
+
+    def _run_calls(self):
+        while self.calls:
+            fn, args = self.calls.popleft()
+            fn(*args)
+
+    def call_soon(self, fn, *args):
+        """Run fn(*args) on the loop thread."""
+        self.calls.append((fn, args))
+        self.waker.wake()
+
+    def run(self):
+        asyncore.loop(timeout=30.0, use_poll=True, map=self.map)
+
+
+_default_loop = None
+_default_loop_lock = threading.Lock()
+
+
+def default_loop():
+    """Return the shared event loop, starting it on first use."""
+    global _default_loop
+    _default_loop_lock.acquire()
+    try:
+        if _default_loop is None:
+            _default_loop = EventLoop()
+            _default_loop.start()
+        return _default_loop
+    finally:
+        _default_loop_lock.release()
+
+
+class _LineChannel(asynchat.async_chat):
+    """ A connection exchanging newline terminated JSON messages.
+
+        After use_codec() it exchanges length-prefixed frames instead.
+    """
+
+    def __init__(self, sock, loop):
+        asynchat.async_chat.__init__(self, sock, map=loop.map)
+        self.loop = loop
+        self.chunks = []
+        self.framing = wire.LineFraming()
+        self.in_header = False
+        self.set_terminator('\n')
+
+    def collect_incoming_data(self, data):
+        self.chunks.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+
+        if isinstance(self.framing, wire.LineFraming):
+            try:
+                message = json.loads(data)
+            except ValueError:
+                return
+
+        elif self.in_header:
+            self.in_header = False
+            self.set_terminator(wire.HEADER.unpack(data)[0])
+            return
+
+        else:
+            self.in_header = True
+            self.set_terminator(wire.HEADER.size)
+            try:
+                message = self.framing.codec.loads(data)
+            except Exception:
+                self.handle_close()
+                return
+
+        self.handle_message(message)
+
+    def use_codec(self, name):
+        """Switch to length-prefixed frames encoded with the named codec."""
+        self.framing = wire.FrameFraming(wire.codecs[name])
+        self.in_header = True
+        self.set_terminator(wire.HEADER.size)
+
+    def send_message(self, message):
+        if self.connected:
+            self.push(self.framing.encode(message))
+
+    def handle_error(self):
+        self.handle_close()
+
+
+class _AsyncRequest(_LineChannel):
+    """Incoming connection of an AsyncSkeleton."""
+
+    def __init__(self, skeleton, sock):
+        _LineChannel.__init__(self, sock, skeleton.loop)
+        self.skeleton = skeleton
+
+    def handle_message(self, request):
+        self.skeleton.serve(self, request)
+
+    def handle_close(self):
+        self.close()
+
+
+class _AsyncServer(asyncore.dispatcher):
+    """Listening socket of an AsyncSkeleton."""
+
+    def __init__(self, skeleton, sock=None):
+        asyncore.dispatcher.__init__(self, sock, map=skeleton.loop.map)
+        self.skeleton = skeleton
+        if sock is None:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind(skeleton.address)
+            self.listen(128)
+        else:
+            # A socket that is already listening, as for Unix sockets.
+            self.accepting = True
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            log.info('orb.accept', "Serving a request",
+                     peer=addr or 'unix')
+            _AsyncRequest(self.skeleton, conn)
+
+
+class AsyncSkeleton(object):
+    """ Event-loop skeleton for a generic owner.
+
+        Has the same interface as orb.Skeleton. Owner methods marked with
+        orb.nonblocking are called on the loop and may return an
+        orb.Future; the others are run on a pool of `workers` threads,
+        and calls that find its queue full are answered with an
+        orb.Overloaded error. Methods in one of the `lanes` have a pool
+        of their own, and identical concurrent calls to idempotent methods
+        run once unless `single_flight` is False, as with orb.Skeleton.
+    """
+
+    def __init__(self, owner, address, loop=None, workers=16,
+                 queue_depth=64, wire_formats=None, lanes=None,
+                 single_flight=True):
+        self.owner = owner
+        self.address = address
+        if wire_formats is None:
+            wire_formats = wire.default_formats
+        self.wire_formats = frozenset(wire_formats)
+        self.loop = loop or default_loop()
+        self.pool = orb.WorkerPool(workers, queue_depth)
+        if lanes is None:
+            lanes = {orb.CONTROL: 4}
+        self.lanes = orb.make_lanes(lanes, queue_depth)
+        self.flights = orb.SingleFlight() if single_flight else None
+        self.metrics = orb.metrics.Registry()
+        self.server = _AsyncServer(self)
+        unix_server = orb.register_local(
+            self, self.server.socket.getsockname(), 128)
+        if unix_server is not None:
+            self.unix_server = _AsyncServer(self, unix_server)
+        # Have the loop poll the new listening sockets.
+        self.loop.waker.wake()
+
+    # Private methods
+
+    def _reply(self, channel, request, response):
+        if not request.get('oneway'):
+            channel.send_message(orb._tag(request, response))
+
+    def _resolved(self, channel, request, started, future):
+        try:
+            response = {'result': future.result()}
+        except Exception, e:
+            response = orb._error_response(e)
+        self.metrics.end(request['method'], started, 'error' in response)
+        self._reply(channel, request, response)
+
+    # Public methods
+
+    def start(self):
+        """Kept for symmetry with orb.Skeleton; the loop is already running."""
+        pass
+
+    def stats(self):
+        """Return the statistics of the served methods and the workers."""
+        return {'methods': self.metrics.snapshot(),
+                'workers': self.pool.stats(),
+                'lanes': dict((name, pool.stats())
+                              for name, pool in self.lanes.iteritems()),
+                'single_flight': self.flights and self.flights.stats()}
+
+    def serve(self, channel, request):
+        """Run a request from the given channel. Called on the loop."""
+        try:
+            orb._check_request(request)
+        except ValueError, e:
+            response = orb._bad_request(request, e)
+            if response is not None:
+                channel.send_message(response)
+            return
+
+        if (request.get('method') == wire.NEGOTIATE and
+                isinstance(channel.framing, wire.LineFraming)):
+            chosen = wire.choose(request['params'][0], self.wire_formats)
+            channel.send_message(orb._tag(request, {'result': chosen}))
+            if chosen is not None:
+                channel.use_codec(chosen)
+            return
+
+        deadline = orb._request_deadline(request)
+        fn = getattr(self.owner, request.get('method', ''), None)
+        if getattr(fn, 'nonblocking', False):
+            if deadline is not None and time.time() >= deadline:
+                self._reply(channel, request, orb._invoke(
+                    self.owner, request, self.metrics, deadline))
+                return
+
+            started = self.metrics.begin(request['method'])
+            try:
+                with orb._deadline_scope(deadline):
+                    result = fn(*request['params'])
+            except Exception, e:
+                self.metrics.end(request['method'], started, True)
+                self._reply(channel, request, orb._error_response(e))
+                return
+
+            if isinstance(result, orb.Future):
+                result.add_done_callback(
+                    lambda f: self.loop.call_soon(self._resolved, channel,
+                                                  request, started, f))
+            else:
+                self.metrics.end(request['method'], started)
+                self._reply(channel, request, {'result': result})
+
+        else:
+            try:
+                future = orb.lane_pool(self, request).submit(
+                    orb._invoke, self.owner, request, self.metrics, deadline,
+                    self.flights)
+            except orb.Overloaded, e:
+                self._reply(channel, request, orb._error_response(e))
+                return
+            future.add_done_callback(
+                lambda f: self.loop.call_soon(self._reply, channel, request,
+                                              f.result()))
+
+
+class _AsyncConnection(_LineChannel):
+    """Outgoing connection of an AsyncStub."""
+
+    def __init__(self, sock, loop):
+        _LineChannel.__init__(self, sock, loop)
+        self.pending = {}
+        self.next_id = 0
+
+    def submit(self, request, future):
+        """Send a request on behalf of the given future. Called on the loop."""
+        if not self.connected:
+            future.set_exception(orb.ComunicationError("Connection is closed"))
+            return
+        rid = self.next_id
+        self.next_id += 1
+        self.pending[rid] = future
+        self.send_message(dict(request, id=rid))
+
+    def handle_message(self, response):
+        future = self.pending.pop(response.get('id'), None)
+        if future is None:
+            return
+        try:
+            future.set_result(orb._unpack(response))
+        except Exception, e:
+            future.set_exception(e)
+
+    def handle_close(self):
+        self.close()
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(
+                orb.ComunicationError("Connection was closed"))
+
+
+class AsyncStub(object):
+    """ Stub whose remote calls return an orb.Future.
+
+        All AsyncStubs on a loop share it for their I/O; the connection is
+        opened on the first call and reopened if it is lost.
+    """
+
+    def __init__(self, address, loop=None):
+        self.address = tuple(address)
+        self.loop = loop or default_loop()
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connection(self):
+        self.lock.acquire()
+        try:
+            if self.conn is None or not self.conn.connected:
+                sock = orb.connect(self.address)
+                sock.setblocking(0)
+                self.conn = _AsyncConnection(sock, self.loop)
+            return self.conn
+        finally:
+            self.lock.release()
+
+    def _rmi(self, method, *args):
+        future = orb.Future()
+        try:
+            conn = self._connection()
+        except socket.error, e:
+            future.set_exception(orb.ComunicationError(str(e)))
+            return future
+        self.loop.call_soon(conn.submit, {'method': method, 'params': args},
+                            future)
+        return future
+
+    def __getattr__(self, attr):
+        """Forward call to name over the network at the given address."""
+        def rmi_call(*args):
+            return self._rmi(attr, *args)
+        return rmi_call
@@ -0,0 +1,176 @@
+# ------------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# ------------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 01 December 2012
+#
+# Copyright 2012 Linkoping University
+# ------------------------------------------------------------------------------
+
+""" Structured logging through a background ring buffer.
+
+    Logging a record only checks its level and sampling rate and appends it
+    to a bounded buffer; a writer thread formats the records and writes
+    them out. Records logged while the buffer is full are dropped and
+    counted, so a slow stream never holds up the callers.
+
+    Used as:
+        log.info('orb.accept', "Serving a request", peer=addr)
+
+    which is written as:
+        2012-12-01 12:00:00.000 INFO orb.accept Serving a request peer=...
+"""
+
+import sys
+import time
+import atexit
+import random
+import threading
+import collections
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_level_names = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING',
+                ERROR: 'ERROR'}
+
+
+class Logger(object):
+    """ Logger writing to a stream from a background thread.
+
+        Records below `level` are ignored. `sampling` maps categories to
+        the fraction of their records that are kept, 1.0 for the others.
+        At most `capacity` records wait to be written.
+    """
+
+    def __init__(self, stream=None, level=INFO, sampling=None,
+                 capacity=4096, flush_interval=0.1):
+        self.stream = stream or sys.stderr
+        self.level = level
+        self.sampling = dict(sampling or {})
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.buffer = collections.deque()
+        self.write_lock = threading.Lock()
+        self.writer = None
+        # Counters
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    # Private methods
+
+    def _format(self, record):
+        when, level, category, message, fields = record
+        stamp = "{0}.{1:03d}".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)),
+            int(when * 1000) % 1000)
+        parts = [stamp, _level_names.get(level, str(level)), category,
+                 message]
+        parts.extend("{0}={1}".format(k, v)
+                     for k, v in sorted(fields.iteritems()))
+        return ' '.join(parts) + '\n'
+
+    def _write(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _start(self):
+        self.write_lock.acquire()
+        try:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write)
+                self.writer.daemon = True
+                self.writer.start()
+        finally:
+            self.write_lock.release()
+
+    # Public methods
+
+    def log(self, level, category, message, **fields):
+        """Queue a record, unless its level or sampling rate leave it out."""
+        if level < self.level:
+            return
+        rate = self.sampling.get(category)
+        if rate is not None and random.random() >= rate:
+            self.sampled_out += 1
+            return
+        if len(self.buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        self.buffer.append((time.time(), level, category, message, fields))
+        if self.writer is None:
+            self._start()
+
+    def debug(self, category, message, **fields):
+        self.log(DEBUG, category, message, **fields)
+
+    def info(self, category, message, **fields):
+        self.log(INFO, category, message, **fields)
+
+    def warning(self, category, message, **fields):
+        self.log(WARNING, category, message, **fields)
+
+    def error(self, category, message, **fields):
+        self.log(ERROR, category, message, **fields)
+
+    def flush(self):
+        """Write out all the queued records."""
+        self.write_lock.acquire()
+        try:
+            lines = []
+            while self.buffer:
+                lines.append(self._format(self.buffer.popleft()))
+            if lines:
+                try:
+                    self.stream.write(''.join(lines))
+                    self.stream.flush()
+                except (IOError, ValueError):
+                    pass
+                self.written += len(lines)
+        finally:
+            self.write_lock.release()
+
+    def stats(self):
+        return {'queued': len(self.buffer),
+                'written': self.written,
+                'dropped': self.dropped,
+                'sampled_out': self.sampled_out}
+
+
+# The logger behind the functions of this module.
+default_logger = Logger()
+atexit.register(default_logger.flush)
+
+
+def configure(stream=None, level=None, sampling=None):
+    """ Change the stream, level or sampling rates of the default logger.
+
+        Sampling rates are merged with the ones already set.
+    """
+    if stream is not None:
+        default_logger.flush()
+        default_logger.stream = stream
+    if level is not None:
+        default_logger.level = level
+    if sampling is not None:
+        default_logger.sampling.update(sampling)
+
+
+def debug(category, message, **fields):
+    default_logger.log(DEBUG, category, message, **fields)
+
+
+def info(category, message, **fields):
+    default_logger.log(INFO, category, message, **fields)
+
+
+def warning(category, message, **fields):
+    default_logger.log(WARNING, category, message, **fields)
+
+
+def error(category, message, **fields):
+    default_logger.log(ERROR, category, message, **fields)
@@ -0,0 +1,149 @@
+# ------------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# ------------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 01 December 2012
+#
+# Copyright 2012 Linkoping University
+# ------------------------------------------------------------------------------
+
+"""Per-method call counters and latency histograms."""
+
+import time
+import bisect
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Latency histogram over fixed buckets, plus an overflow bucket."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of its bucket."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return float('inf') if self.count else 0.0
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                    self.counts)),
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99)}
+
+
+class MethodStats(object):
+    """Counters of a single method."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latency = Histogram()
+
+    def to_dict(self):
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'latency': self.latency.to_dict()}
+
+
+class Registry(object):
+    """ Statistics of all the methods called through one side of the ORB.
+
+        Used as:
+            started = registry.begin(method)
+            ...
+            registry.end(method, started, error)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def _method(self, method):
+        stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = MethodStats()
+        return stats
+
+    def begin(self, method):
+        """Count a call that starts now and return its start time."""
+        self.lock.acquire()
+        try:
+            self._method(method).in_flight += 1
+        finally:
+            self.lock.release()
+        return time.time()
+
+    def end(self, method, started, error=False):
+        """Count a call started at `started` as finished."""
+        elapsed = time.time() - started
+        self.lock.acquire()
+        try:
+            stats = self._method(method)
+            stats.in_flight -= 1
+            stats.calls += 1
+            if error:
+                stats.errors += 1
+            stats.latency.observe(elapsed)
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """Return the statistics of every method as a dictionary."""
+        self.lock.acquire()
+        try:
+            return dict((method, stats.to_dict())
+                        for method, stats in self.methods.iteritems())
+        finally:
+            self.lock.release()
+
+    def prometheus(self, prefix):
+        """Return the statistics in the Prometheus text format."""
+        lines = []
+        self.lock.acquire()
+        try:
+            methods = sorted(self.methods.iteritems())
+            for name, kind, attr in (('calls_total', 'counter', 'calls'),
+                                     ('errors_total', 'counter', 'errors'),
+                                     ('in_flight', 'gauge', 'in_flight')):
+                lines.append("# TYPE {0}_{1} {2}".format(prefix, name, kind))
+                for method, stats in methods:
+                    lines.append('{0}_{1}{{method="{2}"}} {3}'.format(
+                        prefix, name, method, getattr(stats, attr)))
+
+            lines.append("# TYPE {0}_latency_seconds histogram".format(prefix))
+            for method, stats in methods:
+                seen = 0
+                bounds = [repr(b) for b in BUCKETS] + ['+Inf']
+                for bound, count in zip(bounds, stats.latency.counts):
+                    seen += count
+                    lines.append(
+                        '{0}_latency_seconds_bucket{{method="{1}",le="{2}"}} '
+                        '{3}'.format(prefix, method, bound, seen))
+                lines.append('{0}_latency_seconds_sum{{method="{1}"}} {2!r}'
+                             .format(prefix, method, stats.latency.total))
+                lines.append('{0}_latency_seconds_count{{method="{1}"}} {2}'
+                             .format(prefix, method, stats.latency.count))
+        finally:
+            self.lock.release()
+        return ''.join(line + '\n' for line in lines)
@@ -0,0 +1,217 @@
+# ------------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# ------------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 01 December 2012
+#
+# Copyright 2012 Linkoping University
+# ------------------------------------------------------------------------------
+
+"""Client-side cache of name service lookups."""
+
+import os
+import re
+import json
+import time
+import random
+import tempfile
+import threading
+import collections
+
+# Seconds a lookup stays fresh, by method.
+TTLS = {'require_all': 2.0,
+        'require_any': 10.0,
+        'require_object': 30.0}
+
+
+
+def default_path(address):
+    """ Return the file shared by the short-lived clients of a user that
+        call the name service at the given address.
+    """
+    name = "tddd25-name-cache-{0}-{1}-{2}.json".format(
+        getattr(os, 'getuid', lambda: 0)(),
+        re.sub(r'[^A-Za-z0-9.-]', '_', str(address[0])), address[1])
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+def _mentions(value, address):
+    """Tell whether a lookup answer holds the given address."""
+    if isinstance(value, (list, tuple)):
+        return (list(value) == address or
+                any(_mentions(v, address) for v in value))
+    return False
+
+
+class NameServiceCache(object):
+    """ Caching wrapper around a Stub of the name service.
+
+        The lookups listed in `ttls` are answered from the cache while
+        they are fresh; the `size` most recently used ones are kept. An
+        answer of require_any() is also picked at random from a fresh
+        require_all() of the same type. Every other call is forwarded to
+        the stub.
+
+        register() and unregister() through the cache drop the lookups of
+        their type. Callers that fail to reach a looked up address should
+        call invalidate() with it.
+
+        If a `path` is given the cache is kept in that file as well, so
+        that processes started one after the other share it. The file must
+        only hold lookups of the name service of `stub`, see default_path();
+        a file owned by another user is ignored.
+    """
+
+    def __init__(self, stub, ttls=None, size=256, path=None):
+        self.stub = stub
+        self.ttls = dict(TTLS)
+        self.ttls.update(ttls or {})
+        self.size = size
+        self.path = path
+        self.lock = threading.Lock()
+        self.rand = random.Random()
+        self.rand.seed()
+        # (method, args) as JSON -> (expires, value), least recently used
+        # first.
+        self.entries = collections.OrderedDict()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if path is not None:
+            self._load()
+
+    # Private methods
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                if (hasattr(os, 'getuid') and
+                        os.fstat(f.fileno()).st_uid != os.getuid()):
+                    return
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        now = time.time()
+        for key, expires, value in entries:
+            if expires > now:
+                self.entries[key] = (expires, value)
+
+    def _save(self):
+        """Write the cache to its file. Lock must be held."""
+        entries = [[key, expires, value]
+                   for key, (expires, value) in self.entries.iteritems()]
+        tmp = "{0}.{1}".format(self.path, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump(entries, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+    def _get(self, key):
+        """Return the fresh value of a key, or None. Lock must be held."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            return None
+        self.entries[key] = entry
+        return entry
+
+    def _put(self, key, ttl, value):
+        """Store a value. Lock must be held."""
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + ttl, value)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        if self.path is not None:
+            self._save()
+
+    def _drop(self, keep):
+        """Drop the entries for which keep(key, value) is false."""
+        self.lock.acquire()
+        try:
+            for key, (_, value) in self.entries.items():
+                if not keep(json.loads(key), value):
+                    del self.entries[key]
+                    self.invalidations += 1
+            if self.path is not None:
+                self._save()
+        finally:
+            self.lock.release()
+
+    def _lookup(self, method, args):
+        key = json.dumps([method, args])
+        self.lock.acquire()
+        try:
+            entry = self._get(key)
+            if entry is None and method == 'require_any':
+                entry = self._get(json.dumps(['require_all', args]))
+                if entry is not None and entry[1]:
+                    entry = (entry[0], self.rand.choice(entry[1])[1])
+                else:
+                    entry = None
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        finally:
+            self.lock.release()
+
+        value = getattr(self.stub, method)(*args)
+
+        self.lock.acquire()
+        try:
+            self._put(key, self.ttls[method], value)
+        finally:
+            self.lock.release()
+        return value
+
+    # Public methods
+
+    def invalidate(self, ptype=None, address=None):
+        """ Forget the lookups of a type and those answering an address.
+
+            Without arguments the whole cache is dropped.
+        """
+        if ptype is None and address is None:
+            self._drop(lambda key, value: False)
+            return
+
+        def keep(key, value):
+            if ptype is not None and key[1][:1] == [ptype]:
+                return False
+            return address is None or not _mentions(value, list(address))
+
+        self._drop(keep)
+
+    def register(self, ptype, address):
+        self.invalidate(ptype)
+        return self.stub.register(ptype, address)
+
+    def unregister(self, pid, ptype, phash):
+        self.invalidate(ptype)
+        return self.stub.unregister(pid, ptype, phash)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'entries': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations}
+        finally:
+            self.lock.release()
+
+    def __getattr__(self, attr):
+        """Answer cached lookups, forward any other call to the stub."""
+        if attr not in self.ttls:
+            return getattr(self.stub, attr)
+
+        def lookup(*args):
+            return self._lookup(attr, list(args))
+        return lookup
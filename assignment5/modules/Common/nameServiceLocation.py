@@ -2,6 +2,16 @@
 
     This module's role is simply to allow easy maintenance of the lab
     structure if the name service changes address.
+
+    The address can be overridden with the TDDD25_NAME_SERVICE environment
+    variable, given as HOST:PORT, e.g. to use a local name service started
+    with lab5/nameServer.py.
 """
 
+import os
+
 name_service_address = ("seri0.ida.liu.se", 40000)
+
+if os.environ.get("TDDD25_NAME_SERVICE"):
+    _host, _port = os.environ["TDDD25_NAME_SERVICE"].rsplit(":", 1)
+    name_service_address = (_host, int(_port))
@@ -7,9 +7,22 @@
 # Copyright 2012 Linkoping University
 # ------------------------------------------------------------------------------
 
+import os
+import re
+import stat
+import atexit
 import threading
 import socket
-import json
+import time
+import Queue
+import random
+import tempfile
+import contextlib
+
+from Common import log
+from Common import metrics
+from Common import wire
+from Common.nameServiceCache import NameServiceCache
 
 """ Object Request Broker
 
@@ -19,9 +32,26 @@ import json
     --  Strub ::
             Represents the image of a remote object on the local machine.
             Used to connect to remote objects. Also called Proxy.
+    --  ConnectionPool ::
+            Keeps multiplexed keep-alive connections to remote objects so
+            that stubs do not pay a connect for every call.
+    --  CircuitBreakers ::
+            Track the health of every remote address so that calls to a
+            dead peer fail fast instead of stalling one after the other.
     --  Skeleton ::
             Used to listen to incoming connections and forward them to the
             main object.
+    --  Deadlines ::
+            Calls carry the time left to answer them. A skeleton drops the
+            calls whose deadline has passed, and calls made while serving a
+            call inherit what is left of its deadline.
+    --  Local transports ::
+            Stubs calling a skeleton on the same host connect through a
+            Unix domain socket, and stubs calling a skeleton in the same
+            process call its owner directly.
+    --  asyncOrb.AsyncSkeleton ::
+            Event-loop alternative to Skeleton that serves every connection
+            from a single thread. Pass it as the skeleton_class of a Peer.
     --  Peer ::
             Class that implements basic bidirectional (Stub/Skeleton)
             communication. Any object wishing to transparently interact with
@@ -33,34 +63,1541 @@ class ComunicationError(Exception):
     pass
 
 
+class Overloaded(ComunicationError):
+    """Raised when a skeleton sheds a call because it is at capacity."""
+    pass
+
+
+class DeadlineExceeded(ComunicationError):
+    """Raised when a call has not finished before its deadline."""
+    pass
+
+
+class CircuitOpen(ComunicationError):
+    """Raised without calling when the circuit of an address is open."""
+    pass
+
+
+# Remote errors that are raised with their own type on the calling side.
+_remote_errors = {'Overloaded': Overloaded,
+                  'DeadlineExceeded': DeadlineExceeded}
+
+# Deadline of the call served by each thread, see deadline().
+_context = threading.local()
+
+
+def current_deadline():
+    """Return the absolute deadline that calls made now inherit, or None."""
+    return getattr(_context, 'deadline', None)
+
+
+def remaining_time():
+    """Return the seconds left before the current deadline, or None."""
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.time())
+
+
+@contextlib.contextmanager
+def _deadline_scope(deadline):
+    saved = current_deadline()
+    _context.deadline = deadline
+    try:
+        yield
+    finally:
+        _context.deadline = saved
+
+
+def deadline(timeout):
+    """ Return a context in which calls must finish within `timeout` seconds.
+
+        Used as:
+            with orb.deadline(2.0):
+                stub.write(fortune)
+
+        A deadline never extends the one already in force.
+    """
+    deadline = time.time() + timeout
+    inherited = current_deadline()
+    if inherited is not None and inherited < deadline:
+        deadline = inherited
+    return _deadline_scope(deadline)
+
+
+def no_deadline():
+    """ Return a context in which calls do not inherit the current deadline.
+
+        For calls that must go through even if the caller has given up, such
+        as handing a token over to another peer.
+    """
+    return _deadline_scope(None)
+
+
+class Future(object):
+    """ The eventual outcome of a call that is still running.
+
+        A future is either resolved with a result or failed with an
+        exception; callers block in result() until one of the two happens.
+    """
+
+    def __init__(self, timeout=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + timeout
+
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def add_done_callback(self, fn):
+        """Call fn(future) once the future is done, maybe right away."""
+        self._lock.acquire()
+        try:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def done(self):
+        return self._event.is_set()
+
+    def remaining(self, timeout=None):
+        """Return how long to wait given a timeout and the own deadline."""
+        if self.deadline is not None:
+            left = max(0.0, self.deadline - time.time())
+            if timeout is None or left < timeout:
+                return left
+        return timeout
+
+    def result(self, timeout=None):
+        """ Wait for the outcome of the call and return or raise it.
+
+            A future created with a timeout of its own never waits past it.
+        """
+        if not self._event.wait(self.remaining(timeout)):
+            raise DeadlineExceeded("The call did not finish in time")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def wait_all(futures, timeout=None):
+    """ Wait until all the futures are done or the timeout has passed.
+
+        Returns the pair (done, not_done) of lists of futures.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    for future in futures:
+        left = None if deadline is None else max(0.0, deadline - time.time())
+        future._event.wait(future.remaining(left))
+    done = [f for f in futures if f.done()]
+    return done, [f for f in futures if not f.done()]
+
+
+def wait_any(futures, timeout=None):
+    """ Wait until one of the futures is done and return it.
+
+        Returns None if none is done once the timeout has passed.
+    """
+    event = threading.Event()
+    for future in futures:
+        future.add_done_callback(lambda f: event.set())
+    event.wait(timeout)
+    for future in futures:
+        if future.done():
+            return future
+    return None
+
+
+def nonblocking(fn):
+    """ Mark a method of an owner object as never blocking.
+
+        Event-loop skeletons run such methods directly on the loop instead
+        of handing them to a worker thread. A non-blocking method may also
+        return a Future, in which case the reply is sent once it is done.
+    """
+    fn.nonblocking = True
+    return fn
+
+
+def idempotent(fn):
+    """ Mark a method of an owner object as free of side effects.
+
+        Skeletons let identical calls to such a method that arrive while
+        one of them is running share its outcome, see SingleFlight.
+    """
+    fn.idempotent = True
+    return fn
+
+
+class SingleFlight(object):
+    """ Runs identical concurrent calls only once.
+
+        The first call with a given key runs; the calls with the same key
+        that arrive before it has finished wait for it and get the same
+        result or exception.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        # Counters
+        self.runs = 0
+        self.shared = 0
+
+    def run(self, key, fn, *args):
+        self.lock.acquire()
+        try:
+            future = self.flights.get(key)
+            leader = future is None
+            if leader:
+                future = self.flights[key] = Future()
+                self.runs += 1
+            else:
+                self.shared += 1
+        finally:
+            self.lock.release()
+
+        if not leader:
+            return future.result(remaining_time())
+
+        try:
+            result = fn(*args)
+        except Exception, e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self.lock.acquire()
+            del self.flights[key]
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'runs': self.runs,
+                    'shared': self.shared,
+                    'in_flight': len(self.flights)}
+        finally:
+            self.lock.release()
+
+
+# Lane of the calls that keep the peers coordinated, such as token passing.
+CONTROL = 'control'
+
+
+def lane(name):
+    """ Mark a method of an owner object as belonging to a lane.
+
+        Skeletons run the calls of every lane on a worker pool of its own,
+        so a flood of calls in one lane cannot hold up another. Methods
+        without a lane, or with one the skeleton does not know, share the
+        main pool.
+    """
+    def mark(fn):
+        fn.lane = name
+        return fn
+    return mark
+
+
+# Decorator for control-plane methods, see lane().
+control = lane(CONTROL)
+
+
+def make_lanes(lanes, queue_depth):
+    """Return a worker pool for every lane given as {name: workers}."""
+    return dict((name, WorkerPool(workers, queue_depth))
+                for name, workers in lanes.iteritems())
+
+
+def lane_pool(skeleton, request):
+    """Return the worker pool of a skeleton that should run a request."""
+    fn = getattr(skeleton.owner, request.get('method') or '', None)
+    return skeleton.lanes.get(getattr(fn, 'lane', None), skeleton.pool)
+
+
+def _error_response(e, name=None):
+    return {'error': {'name': name or type(e).__name__,
+                      'args': str(e)}}
+
+
+def _tag(request, response):
+    """Copy the id of the request, if any, onto its response."""
+    if isinstance(request, dict) and 'id' in request:
+        response['id'] = request['id']
+    return response
+
+
+def _check_request(request):
+    """ Raise ValueError if a decoded message is not shaped as a request.
+
+        Only the parts read before the owner is called are checked, the
+        method and its params are checked by _invoke().
+    """
+    if not isinstance(request, dict):
+        raise ValueError("A request must be an object")
+    timeout = request.get('timeout')
+    if timeout is not None and not isinstance(timeout, (int, long, float)):
+        raise ValueError("The timeout of a request must be a number")
+    if request.get('method') == wire.NEGOTIATE:
+        params = request.get('params')
+        if (not isinstance(params, (list, tuple)) or not params or
+                not isinstance(params[0], (list, tuple)) or
+                not all(isinstance(name, basestring) for name in params[0])):
+            raise ValueError(
+                "'{0}' takes a list of wire format names".format(
+                    wire.NEGOTIATE))
+    if 'batch' in request:
+        if not isinstance(request['batch'], (list, tuple)):
+            raise ValueError("A batch must be a list of requests")
+        for call in request['batch']:
+            _check_request(call)
+
+
+def _bad_request(request, e):
+    """ Return the reply to a message rejected by _check_request(), or None
+        if it asked for no reply.
+    """
+    if isinstance(request, dict) and request.get('oneway'):
+        return None
+    return _tag(request, _error_response(e, 'ComunicationError'))
+
+
+def _request_deadline(request):
+    """Return the local deadline of a request that has just arrived."""
+    timeout = request.get('timeout')
+    if timeout is None:
+        return None
+    return time.time() + timeout
+
+
+def _call_owner(fn, params):
+    result = fn(*params)
+    if isinstance(result, Future):
+        result = result.result(remaining_time())
+    return result
+
+
+def _invoke(owner, request, registry=None, deadline=None, flights=None):
+    """ Run a decoded request on the owner object and return the reply.
+
+        A batch request, {'batch': [request, ...]}, runs its calls in order
+        and replies with the list of their replies as its result. Every call
+        is counted in the given metrics registry, if any.
+
+        A request whose deadline has passed is not run; the caller has
+        already given up on it. Otherwise the deadline is inherited by the
+        calls the owner makes.
+
+        Identical concurrent calls to idempotent methods share a single run
+        if a SingleFlight is given.
+    """
+    if deadline is not None and time.time() >= deadline:
+        return _tag(request, _error_response(DeadlineExceeded(
+            "The deadline of '{0}' passed before it could run".format(
+                request.get('method', 'batch')))))
+
+    if 'batch' in request:
+        return _tag(request, {'result': [
+            _invoke(owner, call, registry, deadline, flights)
+            for call in request['batch']]})
+
+    if registry is not None:
+        started = registry.begin(request.get('method'))
+    try:
+        fn = getattr(owner, request['method'])
+        params = request['params']
+        with _deadline_scope(deadline):
+            if flights is not None and getattr(fn, 'idempotent', False):
+                key = (request['method'], repr(tuple(params)))
+                result = flights.run(key, _call_owner, fn, params)
+            else:
+                result = _call_owner(fn, params)
+        response = {'result': result}
+
+    except AttributeError, e:
+        response = _error_response(e, 'ComunicationError')
+
+    except Exception, e:
+        response = _error_response(e)
+
+    if registry is not None:
+        registry.end(request.get('method'), started, 'error' in response)
+    return _tag(request, response)
+
+
+def _remote_error(error):
+    """Build the local exception for the error part of a reply."""
+    return _remote_errors.get(error.get('name'), Exception)(error.get('args'))
+
+
+def _unpack(response):
+    """Return the result carried by a reply, or raise its error."""
+    error = response.get('error')
+    if error:
+        raise _remote_error(error)
+
+    return response.get('result')
+
+
+class WorkerPool(object):
+    """ A fixed set of threads running submitted functions.
+
+        submit() returns a Future for the return value of the function. At
+        most `queue_depth` functions wait for a free thread; beyond that
+        submit() sheds the work by raising Overloaded. With a `queue_depth`
+        of 0 nothing waits: work is shed unless a thread is idle. The time
+        spent in the queue is recorded so that the pool can be sized.
+    """
+
+    def __init__(self, size=8, queue_depth=0):
+        if queue_depth < 0:
+            raise ValueError("queue_depth must not be negative")
+        self.size = size
+        self.queue_depth = queue_depth
+        # Queue.Queue(0) would be unbounded, so a depth of 0 is enforced by
+        # submit() with the count of idle threads instead.
+        self.queue = Queue.Queue(queue_depth)
+        self.lock = threading.Lock()
+        self.idle = size
+        # Counters
+        self.submitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        for _ in range(size):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            fn, args, future, queued = self.queue.get()
+            wait = time.time() - queued
+            self.lock.acquire()
+            self.idle -= 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.lock.release()
+            try:
+                future.set_result(fn(*args))
+            except Exception, e:
+                future.set_exception(e)
+            self.lock.acquire()
+            self.idle += 1
+            self.lock.release()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.lock.acquire()
+        try:
+            try:
+                if (self.queue_depth == 0 and
+                        self.queue.qsize() >= self.idle):
+                    raise Queue.Full
+                self.queue.put_nowait((fn, args, future, time.time()))
+            except Queue.Full:
+                self.rejected += 1
+                raise Overloaded("All {0} workers are busy and {1} calls "
+                                 "are queued".format(self.size,
+                                                     self.queue_depth))
+            self.submitted += 1
+        finally:
+            self.lock.release()
+        return future
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            started = self.submitted - self.queue.qsize()
+            return {'workers': self.size,
+                    'queue_depth': self.queue_depth,
+                    'queued': self.queue.qsize(),
+                    'submitted': self.submitted,
+                    'rejected': self.rejected,
+                    'wait_mean': self.wait_total / started if started else 0.0,
+                    'wait_max': self.wait_max}
+        finally:
+            self.lock.release()
+
+
+class Resolver(object):
+    """ Cache of host name lookups.
+
+        Addresses are kept for `ttl` seconds and failed lookups for
+        `negative_ttl` seconds. Concurrent lookups of the same name share
+        a single query, and prefetch() runs one in the background so that
+        it is ready by the time it is needed.
+    """
+
+    def __init__(self, ttl=300.0, negative_ttl=30.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # host -> (expires, addresses or the socket.error of the lookup)
+        self.entries = {}
+        # host -> Future of a lookup in progress
+        self.lookups = {}
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def _start(self, host):
+        """ Return a future for the addresses of a host and whether its
+            lookup is left to the caller.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(host)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                future = Future()
+                if isinstance(entry[1], Exception):
+                    future.set_exception(entry[1])
+                else:
+                    future.set_result(entry[1])
+                return future, False
+
+            future = self.lookups.get(host)
+            if future is not None:
+                self.hits += 1
+                return future, False
+            self.misses += 1
+            future = self.lookups[host] = Future()
+            return future, True
+        finally:
+            self.lock.release()
+
+    def _run(self, host, future):
+        try:
+            result = socket.gethostbyname_ex(host)[2]
+            ttl = self.ttl
+        except Exception, e:
+            # Not only socket.error: malformed names raise UnicodeError.
+            result = e
+            ttl = self.negative_ttl
+
+        try:
+            self.lock.acquire()
+            try:
+                self.entries[host] = (time.time() + ttl, result)
+                if isinstance(result, Exception):
+                    self.failures += 1
+            finally:
+                # Later lookups must not wait for this one any more.
+                self.lookups.pop(host, None)
+                self.lock.release()
+        finally:
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def addresses(self, host):
+        """ Return the IPv4 addresses of a host name.
+
+            Raises the error of the lookup if it failed, usually a
+            socket.error.
+        """
+        future, started = self._start(host)
+        if started:
+            self._run(host, future)
+        return future.result()
+
+    def prefetch(self, host):
+        """Start looking a host name up in the background."""
+        future, started = self._start(host)
+        if started:
+            lookup = threading.Thread(target=self._run, args=(host, future))
+            lookup.daemon = True
+            lookup.start()
+
+    def resolve(self, address):
+        """Return an address with its host name replaced by an IP address."""
+        host = address[0]
+        if not host:
+            return address
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, host)
+                return address
+            except (socket.error, ValueError):
+                pass
+        return (self.addresses(host)[0],) + tuple(address[1:])
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'entries': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'failures': self.failures}
+        finally:
+            self.lock.release()
+
+
+# The resolver used by all stubs and peers.
+default_resolver = Resolver()
+
+# Seconds to wait for a connection to be set up.
+connect_timeout = 10.0
+
+# Whether stubs use Unix domain sockets and in-process calls to reach
+# skeletons on the same host.
+local_transports = True
+
+# Skeletons living in this process, by port.
+_local_skeletons = {}
+
+_local_hosts = None
+
+
+# Unix domain socket files created by this process, with their device and
+# inode, so that only files still ours are removed at exit.
+_unix_paths = {}
+
+
+def unix_dir():
+    """ Return the directory of this user's Unix domain sockets.
+
+        The directory is created with mode 0700, so that no other user can
+        put a socket there. Returns None if it is not a directory of ours
+        that only we can reach.
+    """
+    path = os.path.join(tempfile.gettempdir(),
+                        "orb-{0}".format(os.getuid()))
+    try:
+        os.mkdir(path, 0700)
+    except OSError:
+        pass
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 077):
+        return None
+    return path
+
+
+def unix_path(host, port):
+    """ Return the path of the Unix domain socket of a skeleton's address.
+
+        Skeletons bound to all interfaces use the host name 'any'. Returns
+        None if there is no safe directory for it, see unix_dir().
+    """
+    directory = unix_dir()
+    if directory is None:
+        return None
+    if host in ('', '0.0.0.0'):
+        host = 'any'
+    else:
+        try:
+            host = default_resolver.resolve((host, port))[0]
+        except (socket.error, UnicodeError):
+            pass
+    host = re.sub(r'[^A-Za-z0-9.-]', '_', host)
+    return os.path.join(directory, "{0}-{1}.sock".format(host, port))
+
+
+def _remove_unix_paths():
+    for path, ident in _unix_paths.items():
+        try:
+            st = os.stat(path)
+            if (st.st_dev, st.st_ino) == ident:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+atexit.register(_remove_unix_paths)
+
+
+def is_local(host):
+    """Tell whether a host name or address belongs to this machine."""
+    global _local_hosts
+    if _local_hosts is None:
+        hosts = set(["", "localhost", "127.0.0.1", "0.0.0.0",
+                     socket.gethostname()])
+        try:
+            hosts.update(default_resolver.addresses(socket.gethostname()))
+        except (socket.error, UnicodeError):
+            pass
+        _local_hosts = hosts
+    return host in _local_hosts
+
+
+def local_skeleton(address):
+    """Return the skeleton of this process serving an address, if any."""
+    skeleton = _local_skeletons.get(address[1])
+    if skeleton is not None and is_local(address[0]):
+        return skeleton
+    return None
+
+
+def register_local(skeleton, address, backlog):
+    """ Make a skeleton listening to an address reachable by local
+        transports.
+
+        Returns the Unix domain socket listening for the skeleton, or None
+        if local transports are off, not supported or cannot be set up, in
+        which case local stubs use TCP. The socket file is removed when the
+        process exits.
+    """
+    host, port = address[:2]
+    _local_skeletons[port] = skeleton
+    if not local_transports or not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    path = unix_path(host, port)
+    if path is None:
+        log.warning('orb.local', "No private directory for Unix sockets",
+                    directory=tempfile.gettempdir())
+        return None
+    try:
+        # We own the TCP address, so a socket file for it is a stale one.
+        os.unlink(path)
+    except OSError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        server.listen(backlog)
+        st = os.stat(path)
+    except (socket.error, OSError), e:
+        server.close()
+        log.warning('orb.local', "Cannot listen to a Unix socket",
+                    path=path, error=str(e))
+        return None
+    _unix_paths[path] = (st.st_dev, st.st_ino)
+    return server
+
+
+def connect(address, timeout=None):
+    """ Open a stream socket to an address.
+
+        A Unix domain socket is used if the address is on this host and
+        its skeleton, bound to that address or to all interfaces, listens
+        to one in our unix_dir(); TCP is used otherwise. The socket is
+        left with the given timeout. Host names are looked up through
+        default_resolver, not at every connect.
+    """
+    if local_transports and hasattr(socket, 'AF_UNIX') and is_local(address[0]):
+        for host in (address[0], ''):
+            path = unix_path(host, address[1])
+            if path is None or not os.path.exists(path):
+                continue
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(path)
+                return sock
+            except socket.error:
+                sock.close()
+    return socket.create_connection(default_resolver.resolve(address),
+                                    timeout)
+
+
+class Connection(object):
+    """ A long-lived, multiplexed connection to a remote skeleton.
+
+        Every call is sent tagged with a request id, so any number of
+        threads can have calls in flight on the same connection. A reader
+        thread matches the replies, which may arrive in any order, with the
+        futures of the waiting callers.
+
+        Skeletons that predate request ids answer a single call and close
+        the connection, so a connection only takes more than one call once
+        the remote end has tagged a reply, see `tagged`.
+
+        Messages are JSON lines unless another `wire_format` is asked for
+        (see the wire module) and the remote end agrees to it.
+    """
+
+    def __init__(self, address, wire_format='json-lines'):
+        self.address = address
+        self.sock = connect(address, connect_timeout)
+        self.framing = wire.LineFraming()
+        # Whether the remote end is known to tag its replies with request
+        # ids; skeletons that negotiate wire formats all do.
+        self.tagged = False
+        if wire_format != self.framing.name:
+            self.tagged = self._negotiate(wire_format)
+            if not self.tagged:
+                # The remote end only knows JSON lines and may have dropped
+                # the connection after refusing, so start over on a fresh
+                # one.
+                self.sock.close()
+                self.sock = connect(address, connect_timeout)
+        self.sock.settimeout(None)
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+        self.last_used = time.time()
+
+        reader = threading.Thread(target=self._read_replies)
+        reader.daemon = True
+        reader.start()
+
+    # Private methods
+
+    def _negotiate(self, wire_format):
+        """ Ask the remote end to switch to the given wire format.
+
+            Returns False if the remote end does not know about wire
+            formats at all, True otherwise, even if it declined this one.
+        """
+        self.sock.sendall(self.framing.encode(
+            {'method': wire.NEGOTIATE, 'params': [[wire_format]]}))
+        replies = []
+        while not replies:
+            data = self.sock.recv(4096)
+            if not data:
+                return False
+            replies = self.framing.feed(data)
+
+        if replies[0].get('error'):
+            return False
+        chosen = replies[0].get('result')
+        if chosen in wire.codecs:
+            self.framing = wire.FrameFraming(wire.codecs[chosen])
+        return True
+
+    def _read_replies(self):
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+
+                for response in self.framing.feed(data):
+                    self.lock.acquire()
+                    try:
+                        rid = response.get('id')
+                        if rid is not None:
+                            self.tagged = True
+                        elif len(self.pending) == 1:
+                            # A skeleton that predates request ids; it was
+                            # sent a single call.
+                            rid = self.pending.keys()[0]
+                        future = self.pending.pop(rid, None)
+                        self.last_used = time.time()
+                    finally:
+                        self.lock.release()
+
+                    if future is not None:
+                        future.set_result(response)
+
+        except (socket.error, ValueError):
+            pass
+
+        finally:
+            self.close()
+
+    # Public methods
+
+    def in_flight(self):
+        return len(self.pending)
+
+    def submit(self, request):
+        """ Send a request and return a future for its (raw) JSON reply.
+
+            Raises ComunicationError if the request could not be sent, in
+            which case the remote end has not run it.
+        """
+        future = Future()
+
+        self.lock.acquire()
+        try:
+            if self.closed:
+                raise ComunicationError(
+                    "Connection to {0} is closed".format(self.address))
+            rid = self.next_id
+            self.next_id += 1
+            self.pending[rid] = future
+            self.last_used = time.time()
+        finally:
+            self.lock.release()
+
+        data = self.framing.encode(dict(request, id=rid))
+        self.write_lock.acquire()
+        try:
+            self.sock.sendall(data)
+        except socket.error, e:
+            self.close()
+            raise ComunicationError(
+                "Connection to {0} failed: {1}".format(self.address, e))
+        finally:
+            self.write_lock.release()
+
+        return future
+
+    def cancel(self, future):
+        """ Stop waiting for the reply to a submitted request.
+
+            Skeletons that do not tag their replies answer in order, so the
+            connection to one of them is closed rather than left out of step.
+        """
+        self.lock.acquire()
+        try:
+            for rid, pending in self.pending.items():
+                if pending is future:
+                    del self.pending[rid]
+                    break
+            tagged = self.tagged
+        finally:
+            self.lock.release()
+
+        if not tagged:
+            self.close()
+
+    def send(self, request):
+        """Send a one-way request, for which no reply will come."""
+        if self.closed:
+            raise ComunicationError(
+                "Connection to {0} is closed".format(self.address))
+
+        data = self.framing.encode(dict(request, oneway=True))
+        self.write_lock.acquire()
+        try:
+            self.sock.sendall(data)
+            self.last_used = time.time()
+        except socket.error, e:
+            self.close()
+            raise ComunicationError(
+                "Connection to {0} failed: {1}".format(self.address, e))
+        finally:
+            self.write_lock.release()
+
+    def close(self):
+        """Close the connection and fail all the calls still waiting."""
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        finally:
+            self.lock.release()
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+        for future in pending.values():
+            future.set_exception(ComunicationError(
+                "Connection to {0} was closed".format(self.address)))
+
+
+class ConnectionPool(object):
+    """ Per-address pool of shared keep-alive connections.
+
+        At most `size` connections are opened to each address; once they
+        are all busy, new calls are pipelined on the least loaded one. Only
+        connections whose remote end has tagged a reply are shared; until
+        then every call gets a connection of its own, as skeletons that
+        predate request ids need.
+        Connections without calls in flight that have been idle for longer
+        than `idle_timeout` seconds are closed instead of being reused.
+    """
+
+    def __init__(self, size=4, idle_timeout=30.0):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.conns = {}
+        self.opening = {}
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.retries = 0
+
+    def acquire(self, address, wire_format='json-lines'):
+        """ Return a tuple (connection, reused) for the given address.
+
+            Connections using different wire formats are kept apart.
+        """
+        address = (address, wire_format)
+        now = time.time()
+        stale = []
+        self.lock.acquire()
+        try:
+            live = []
+            for conn in self.conns.get(address, []):
+                if conn.closed:
+                    continue
+                if (conn.in_flight() == 0 and
+                        now - conn.last_used >= self.idle_timeout):
+                    self.expired += 1
+                    stale.append(conn)
+                    continue
+                live.append(conn)
+            self.conns[address] = live
+
+            shared = [conn for conn in live if conn.tagged]
+            if shared:
+                best = min(shared, key=lambda c: c.in_flight())
+                opening = self.opening.get(address, 0)
+                if (best.in_flight() == 0 or
+                        len(live) + opening >= self.size):
+                    self.hits += 1
+                    return best, True
+            self.misses += 1
+            self.opening[address] = self.opening.get(address, 0) + 1
+        finally:
+            self.lock.release()
+            for conn in stale:
+                conn.close()
+
+        conn = None
+        try:
+            conn = Connection(*address)
+        finally:
+            self.lock.acquire()
+            try:
+                self.opening[address] -= 1
+                if conn is not None:
+                    self.conns.setdefault(address, []).append(conn)
+            finally:
+                self.lock.release()
+        return conn, False
+
+    def retried(self):
+        """Count a call sent again over a fresh connection."""
+        self.lock.acquire()
+        try:
+            self.retries += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Close all connections."""
+        self.lock.acquire()
+        try:
+            conns, self.conns = self.conns, {}
+        finally:
+            self.lock.release()
+        for address_conns in conns.values():
+            for conn in address_conns:
+                conn.close()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'expired': self.expired,
+                    'retries': self.retries,
+                    'open': sum(len(c) for c in self.conns.values())}
+        finally:
+            self.lock.release()
+
+
+# The pool shared by all stubs that do not ask for a pool of their own.
+default_pool = ConnectionPool()
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class _Circuit(object):
+    """Health of a single address."""
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = None
+        # Counters
+        self.calls = 0
+        self.failed = 0
+        self.rejected = 0
+        self.trips = 0
+
+
+class CircuitBreakers(object):
+    """ Per-address circuit breakers.
+
+        An address starts closed: calls go through and failures are
+        counted. After `threshold` failures in a row its circuit opens and
+        calls fail right away with CircuitOpen. Once `reset_timeout`
+        seconds have passed it is half-open: a single probe call goes
+        through, closing the circuit if it succeeds and opening it again
+        if it fails.
+
+        Used as:
+            breakers.allow(address)
+            ...
+            breakers.record(address, ok)
+    """
+
+    def __init__(self, threshold=3, reset_timeout=5.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.circuits = {}
+
+    def _circuit(self, address):
+        circuit = self.circuits.get(address)
+        if circuit is None:
+            circuit = self.circuits[address] = _Circuit()
+        return circuit
+
+    def allow(self, address):
+        """Raise CircuitOpen unless a call to the address may go through."""
+        self.lock.acquire()
+        try:
+            circuit = self._circuit(address)
+            now = time.time()
+            if (circuit.state == OPEN and
+                    now - circuit.opened_at >= self.reset_timeout):
+                circuit.state = HALF_OPEN
+                circuit.probe_started = None
+
+            # A probe whose outcome never came counts as lost.
+            if circuit.state == HALF_OPEN and (
+                    circuit.probe_started is None or
+                    now - circuit.probe_started >= self.reset_timeout):
+                circuit.probe_started = now
+            elif circuit.state != CLOSED:
+                circuit.rejected += 1
+                raise CircuitOpen("The circuit to {0} is {1}".format(
+                    address, circuit.state))
+            circuit.calls += 1
+        finally:
+            self.lock.release()
+
+    def record(self, address, ok):
+        """Record the outcome of a call that allow() let through."""
+        self.lock.acquire()
+        try:
+            circuit = self._circuit(address)
+            if ok:
+                circuit.state = CLOSED
+                circuit.failures = 0
+            else:
+                circuit.failed += 1
+                circuit.failures += 1
+                if (circuit.state == HALF_OPEN or
+                        circuit.failures >= self.threshold):
+                    if circuit.state != OPEN:
+                        circuit.trips += 1
+                    circuit.state = OPEN
+                    circuit.opened_at = time.time()
+            circuit.probe_started = None
+        finally:
+            self.lock.release()
+
+    def state(self, address):
+        self.lock.acquire()
+        try:
+            return self._circuit(address).state
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return the state and counters of every address, by "host:port"."""
+        self.lock.acquire()
+        try:
+            return dict(("{0}:{1}".format(*address),
+                         {'state': circuit.state,
+                          'failures': circuit.failures,
+                          'calls': circuit.calls,
+                          'failed': circuit.failed,
+                          'rejected': circuit.rejected,
+                          'trips': circuit.trips})
+                        for address, circuit in self.circuits.iteritems())
+        finally:
+            self.lock.release()
+
+
+# The breakers shared by all stubs that do not ask for their own.
+default_breakers = CircuitBreakers()
+
+
+def _is_failure(e):
+    """Tell whether an error raised by a call means that its peer is unwell."""
+    return (isinstance(e, (socket.error, ComunicationError)) and
+            not isinstance(e, (Overloaded, CircuitOpen)))
+
+
+def _shed(response):
+    """Tell whether a reply is a skeleton shedding the call."""
+    error = response.get('error')
+    return bool(error) and error.get('name') == 'Overloaded'
+
+# Wire format of the stubs that do not ask for one of their own.
+default_wire_format = 'json-lines'
+
+# Timeout, in seconds, of the calls of stubs created without one.
+default_timeout = None
+
+# Statistics of all the calls made through stubs in this process.
+client_metrics = metrics.Registry()
+
+
 class Stub(object):
     """ Stub for generic objects distributed over the network.
 
-        This is  wrapper object for a socket.
+        This is  wrapper object for a socket. Connections are taken from a
+        ConnectionPool and shared with other stubs and threads calling the
+        same address.
+
+        Calls to the methods listed in `oneway` do not wait for the remote
+        method to run and always return None; any other method can be
+        called that way through the `oneway` attribute, as in
+        stub.oneway.display_peers(). One-way calls are best effort: the
+        skeleton runs the calls of a connection concurrently, so they may
+        run in any order relative to other calls, and it drops the ones it
+        has no room for, or whose deadline has passed, without telling
+        the caller. Calls that must not be lost or reordered are two-way.
+
+        Calls made with async_call(), or through the `async_` attribute,
+        return a Future right away. Their replies are picked up by the
+        reader threads of the shared connections.
+
+        `wire_format` names a codec of the wire module to use instead of
+        JSON lines when the remote end supports it.
+
+        Unless `in_process` is False, a stub for a skeleton of the same
+        process calls its owner directly, without a socket or serialization.
+        The arguments are then passed by reference, so the owner must not
+        keep or change them. Such calls run on the calling thread unless
+        they have a deadline, in which case they run on the workers of the
+        skeleton so that the caller can stop waiting.
+
+        Calls that have not been answered within `timeout` seconds raise
+        DeadlineExceeded. A call made while serving another one never waits
+        past the deadline of that call, see deadline(). The time left is
+        sent along, so the remote end drops the call once nobody waits for
+        it.
+
+        Calls to an address that keeps failing are stopped by a circuit
+        breaker, see CircuitBreakers. Calls to the methods listed in
+        `idempotent`, which are safe to run twice, are retried up to
+        `retries` times after a transport failure or an Overloaded reply,
+        waiting a random time of up to `backoff` seconds, doubled at each
+        attempt, in between.
     """
 
-    def __init__(self, address):
+    def __init__(self, address, pool=None, oneway=(), wire_format=None,
+                 in_process=True, timeout=None, breakers=None, idempotent=(),
+                 retries=2, backoff=0.05):
         self.address = tuple(address)
+        self.pool = pool or default_pool
+        self.breakers = breakers or default_breakers
+        self.idempotent = frozenset(idempotent)
+        self.retries = retries
+        self.backoff = backoff
+        self.oneway_methods = frozenset(oneway)
+        self.wire_format = wire_format or default_wire_format
+        self.in_process = in_process
+        if timeout is None:
+            timeout = default_timeout
+        self.timeout = timeout
+
+    @property
+    def oneway(self):
+        return OneWay(self)
+
+    @property
+    def async_(self):
+        return Async(self)
+
+    def _local(self):
+        if local_transports and self.in_process:
+            return local_skeleton(self.address)
+        return None
+
+    def _deadline(self, request, timeout=None):
+        """ Stamp a request made now with its time budget.
+
+            The budget is the smallest of the timeout of the stub, the
+            given timeout and the time left to the current deadline.
+            Returns the absolute deadline of the request, or None.
+        """
+        deadline = current_deadline()
+        now = time.time()
+        for limit in (self.timeout, timeout):
+            if limit is not None and (deadline is None or
+                                      now + limit < deadline):
+                deadline = now + limit
+
+        if deadline is not None:
+            if deadline <= now:
+                raise DeadlineExceeded("No time is left to call '{0}'".format(
+                    request.get('method', 'batch')))
+            request['timeout'] = deadline - now
+        return deadline
+
+    def _wait(self, conn, reply, deadline):
+        timeout = None
+        if deadline is not None:
+            timeout = max(0.0, deadline - time.time())
+        try:
+            return reply.result(timeout)
+        except DeadlineExceeded:
+            conn.cancel(reply)
+            raise
+
+    def _call(self, request, deadline=None):
+        skeleton = self._local()
+        if skeleton is not None:
+            if deadline is None:
+                return _invoke(skeleton.owner, request, skeleton.metrics,
+                               deadline, skeleton.flights)
+            # Run on the workers of the skeleton, as a remote call would, so
+            # that the caller stops waiting at the deadline.
+            try:
+                reply = lane_pool(skeleton, request).submit(
+                    _invoke, skeleton.owner, request, skeleton.metrics,
+                    deadline, skeleton.flights)
+            except Overloaded, e:
+                return _tag(request, _error_response(e))
+            return reply.result(max(0.0, deadline - time.time()))
+
+        conn, reused = self.pool.acquire(self.address, self.wire_format)
+        try:
+            reply = conn.submit(request)
+        except ComunicationError:
+            # Nothing was sent, so the call can go over a fresh connection.
+            if not reused:
+                raise
+            self.pool.retried()
+            conn, _ = self.pool.acquire(self.address, self.wire_format)
+            return self._wait(conn, conn.submit(request), deadline)
+
+        try:
+            return self._wait(conn, reply, deadline)
+        except DeadlineExceeded:
+            raise
+        except ComunicationError:
+            # The remote end may have dropped an idle connection, but it may
+            # also have run the call, so only idempotent ones are sent
+            # again.
+            if (not reused or not conn.closed or
+                    request.get('method') not in self.idempotent):
+                raise
+        self.pool.retried()
+        conn, _ = self.pool.acquire(self.address, self.wire_format)
+        return self._wait(conn, conn.submit(request), deadline)
+
+    def _guarded_call(self, method, request, deadline):
+        """ Run _call() behind the circuit breaker of the address.
+
+            Idempotent methods are retried with a jittered backoff.
+        """
+        attempts = 1
+        if method in self.idempotent:
+            attempts += self.retries
+        failure = None
+
+        for attempt in range(attempts):
+            try:
+                self.breakers.allow(self.address)
+            except CircuitOpen:
+                # Report what made the circuit open rather than the circuit.
+                if attempt and failure is not None:
+                    raise failure
+                raise
+            try:
+                response = self._call(request, deadline)
+            except Exception, e:
+                self.breakers.record(self.address, not _is_failure(e))
+                if not _is_failure(e) or isinstance(e, DeadlineExceeded):
+                    raise
+                failure = e
+            else:
+                self.breakers.record(self.address, True)
+                if not _shed(response):
+                    return response
+                failure = None
+
+            if attempt + 1 == attempts:
+                break
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if deadline is not None and time.time() + delay >= deadline:
+                break
+            time.sleep(delay)
+
+        if failure is not None:
+            raise failure
+        return response
+
+    def _send(self, request, deadline=None):
+        skeleton = self._local()
+        if skeleton is not None:
+            lane_pool(skeleton, request).submit(
+                _invoke, skeleton.owner, dict(request, oneway=True),
+                skeleton.metrics, deadline, skeleton.flights)
+            return
+
+        conn, reused = self.pool.acquire(self.address, self.wire_format)
+        try:
+            conn.send(request)
+            return
+        except ComunicationError:
+            if not reused:
+                raise
+        self.pool.retried()
+        conn, _ = self.pool.acquire(self.address, self.wire_format)
+        conn.send(request)
+
+    def async_call(self, method, *args, **kwargs):
+        """ Start a call and return a Future for its result.
+
+            The optional `timeout` shortens the deadline of the call, which
+            also bounds how long result() waits. Calls made this way are
+            only sent again when the request never left this process, even
+            to methods listed in `idempotent`.
+        """
+        timeout = kwargs.pop('timeout', None)
+        future = Future()
+        request = {'method': method, 'params': args}
+        started = client_metrics.begin(method)
+
+        def resolve(reply):
+            try:
+                result = _unpack(reply.result())
+            except Exception, e:
+                self.breakers.record(self.address, not _is_failure(e))
+                client_metrics.end(method, started, True)
+                future.set_exception(e)
+            else:
+                self.breakers.record(self.address, True)
+                client_metrics.end(method, started)
+                future.set_result(result)
+
+        skeleton = self._local()
+        try:
+            future.deadline = self._deadline(request, timeout)
+            self.breakers.allow(self.address)
+            if skeleton is not None:
+                reply = lane_pool(skeleton, request).submit(
+                    _invoke, skeleton.owner, request, skeleton.metrics,
+                    future.deadline, skeleton.flights)
+            else:
+                conn, reused = self.pool.acquire(self.address,
+                                                 self.wire_format)
+                try:
+                    reply = conn.submit(request)
+                except ComunicationError:
+                    if not reused:
+                        raise
+                    self.pool.retried()
+                    conn, _ = self.pool.acquire(self.address,
+                                                self.wire_format)
+                    reply = conn.submit(request)
+        except (socket.error, ComunicationError), e:
+            if not isinstance(e, CircuitOpen):
+                self.breakers.record(self.address, not _is_failure(e))
+            client_metrics.end(method, started, True)
+            future.set_exception(e)
+            return future
+
+        reply.add_done_callback(resolve)
+        return future
+
+    def _oneway(self, method, args):
+        started = client_metrics.begin(method)
+        error = True
+        try:
+            request = {'method': method, 'params': args}
+            deadline = self._deadline(request)
+            self.breakers.allow(self.address)
+            try:
+                self._send(request, deadline)
+            except Exception, e:
+                self.breakers.record(self.address, not _is_failure(e))
+                raise
+            self.breakers.record(self.address, True)
+            error = False
+        finally:
+            client_metrics.end(method, started, error)
 
     def _rmi(self, method, *args):
-        data = ''.join((json.dumps({'method': method, 'params': args}), '\n'))
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(self.address)
+        if method in self.oneway_methods:
+            self._oneway(method, args)
+            return None
 
-        # Treat the socket as a file stream.
-        worker = s.makefile()
-        # Send the result.
-        worker.write(data)
-        worker.flush()
+        started = client_metrics.begin(method)
+        error = True
+        try:
+            request = {'method': method, 'params': args}
+            result = _unpack(self._guarded_call(method, request,
+                                                self._deadline(request)))
+            error = False
+            return result
+        finally:
+            client_metrics.end(method, started, error)
 
-        # Read the request in a serialized form (JSON).
-        response = json.loads(worker.readline())
+    def call_many(self, calls):
+        """ Run a list of (method, args) calls in a single round trip.
 
-        error = response.get('error')
-        if error:
-            raise Exception(error.get('args'))
+            The calls run in order on the remote object. The returned list
+            holds the result of every call, or the exception it raised.
+        """
+        batch = [{'method': method, 'params': args} for method, args in calls]
+        started = client_metrics.begin('batch')
+        error = True
+        try:
+            request = {'batch': batch}
+            responses = _unpack(self._guarded_call('batch', request,
+                                                   self._deadline(request)))
+            error = False
+        finally:
+            client_metrics.end('batch', started, error)
 
-        return response.get('result')
+        results = []
+        for response in responses:
+            if response.get('error'):
+                results.append(_remote_error(response['error']))
+            else:
+                results.append(response.get('result'))
+        return results
+
+    def batch(self):
+        """ Return a Batch that collects calls to this stub.
+
+            Used as:
+                with stub.batch() as b:
+                    first = b.read()
+                    second = b.read()
+                print first.result(), second.result()
+        """
+        return Batch(self)
 
     def __getattr__(self, attr):
         """Forward call to name over the network at the given address."""
@@ -69,30 +1606,185 @@ class Stub(object):
         return rmi_call
 
 
+class OneWay(object):
+    """ View of a Stub whose calls are sent one-way.
+
+        A one-way call returns as soon as it has been sent. The remote
+        object runs it but sends no reply, so its result and any error it
+        raises are lost.
+    """
+
+    def __init__(self, stub):
+        self.stub = stub
+
+    def __getattr__(self, attr):
+        """Send a one-way call to name at the address of the stub."""
+        def oneway_call(*args):
+            self.stub._oneway(attr, args)
+        return oneway_call
+
+
+class Async(object):
+    """View of a Stub whose calls return a Future, see Stub.async_call."""
+
+    def __init__(self, stub):
+        self.stub = stub
+
+    def __getattr__(self, attr):
+        """Start a call to name at the address of the stub."""
+        def async_call(*args):
+            return self.stub.async_call(attr, *args)
+        return async_call
+
+
+class Batch(object):
+    """ Calls collected for a Stub and sent together on leaving the block.
+
+        Every call made on the batch returns a Future that is resolved with
+        its own result or error once the batch has been sent.
+    """
+
+    def __init__(self, stub):
+        self.stub = stub
+        self.calls = []
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None or not self.calls:
+            return False
+        calls, self.calls = self.calls, []
+        futures, self.futures = self.futures, []
+        try:
+            results = self.stub.call_many(calls)
+        except Exception, e:
+            for future in futures:
+                future.set_exception(e)
+            raise
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        return False
+
+    def __getattr__(self, attr):
+        """Record a call to be sent with the batch."""
+        def batch_call(*args):
+            future = Future()
+            self.calls.append((attr, args))
+            self.futures.append(future)
+            return future
+        return batch_call
+
+
 class Request(threading.Thread):
-    """Run the incoming requests on the owner object of the skeleton."""
+    """ Run the incoming requests on the owner object of the skeleton.
+
+        Requests are read one at a time and handed to the worker pool of
+        the skeleton, so replies are written as soon as they are ready and
+        carry the id of the request they answer; one-way requests get no
+        reply at all. Requests the pool has no room for are answered right
+        away with an Overloaded error. The connection is served until the
+        caller closes it or stays idle for the idle timeout of the skeleton.
 
-    def __init__(self, owner, conn, addr):
+        A connection starts with JSON lines and switches to length-prefixed
+        frames if the caller negotiates a wire format the skeleton accepts.
+        Messages that are not shaped as requests are answered with an error.
+    """
+
+    def __init__(self, skeleton, conn, addr):
         threading.Thread.__init__(self)
         self.addr = addr
         self.conn = conn
-        self.owner = owner
+        self.skeleton = skeleton
+        self.owner = skeleton.owner
         self.daemon = True
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.framing = wire.LineFraming()
+
+    def process_request(self, request, deadline=None):
+        """Run a single request and return the reply."""
+        return _invoke(self.owner, request, self.skeleton.metrics, deadline,
+                       self.skeleton.flights)
+
+    def _send(self, response):
+        self.lock.acquire()
+        try:
+            self.conn.sendall(self.framing.encode(response))
+        finally:
+            self.lock.release()
+
+    def _serve(self, request, deadline):
+        try:
+            response = self.process_request(request, deadline)
+            if not request.get('oneway'):
+                self._send(response)
+        except socket.error:
+            # The caller has gone away; nothing left to answer.
+            pass
+        finally:
+            self.lock.acquire()
+            self.in_flight -= 1
+            self.lock.release()
+
+    def _negotiate(self, request):
+        chosen = wire.choose(request['params'][0], self.skeleton.wire_formats)
+        self._send(_tag(request, {'result': chosen}))
+        if chosen is not None:
+            self.framing = wire.FrameFraming(wire.codecs[chosen])
+
+    def _dispatch(self, request):
+        try:
+            _check_request(request)
+        except ValueError, e:
+            response = _bad_request(request, e)
+            if response is not None:
+                self._send(response)
+            return
+
+        if (request.get('method') == wire.NEGOTIATE and
+                isinstance(self.framing, wire.LineFraming)):
+            self._negotiate(request)
+            return
+
+        self.lock.acquire()
+        self.in_flight += 1
+        self.lock.release()
+
+        try:
+            lane_pool(self.skeleton, request).submit(
+                self._serve, request, _request_deadline(request))
+        except Overloaded, e:
+            self.lock.acquire()
+            self.in_flight -= 1
+            self.lock.release()
+            if not request.get('oneway'):
+                self._send(_tag(request, _error_response(e)))
 
     def run(self):
-        worker = self.conn.makefile()
-        request = json.loads(worker.readline())
+        self.conn.settimeout(self.skeleton.idle_timeout)
 
         try:
-            fn = getattr(self.owner, request['method'])
-            result = fn(*request['params'])
+            while True:
+                try:
+                    data = self.conn.recv(4096)
+                except socket.timeout:
+                    if self.in_flight:
+                        continue
+                    break
+                if not data:
+                    break
 
-            worker.write(''.join((json.dumps({'result': result}), '\n')))
+                for request in self.framing.feed(data):
+                    self._dispatch(request)
 
-        except AttributeError, e:
-            response = json.dumps({'error': {'name': 'ComunicationError',
-                                             'args': e}})
-            worker.write(''.join(response, '\n'))
+        except (socket.error, ValueError):
+            # Dead callers end the connection.
+            pass
 
         finally:
             self.conn.close()
@@ -103,44 +1795,106 @@ class Skeleton(threading.Thread):
 
         This is used to listen to an address of the network, manage incoming
         connections and forward calls to the generic owner class.
+
+        Calls are run on a pool of `workers` threads with room for
+        `queue_depth` waiting calls; `backlog` is the length of the queue
+        of connections not yet accepted. Callers may switch to any of the
+        codecs named in `wire_formats`, by default wire.default_formats.
+
+        `lanes` maps lane names to the number of workers of their own
+        pool, see lane(). By default control-plane calls get 4 workers.
+
+        Identical concurrent calls to methods marked with idempotent() run
+        once, unless `single_flight` is False.
     """
 
-    def __init__(self, owner, address):
+    def __init__(self, owner, address, idle_timeout=60.0, workers=16,
+                 queue_depth=64, backlog=128, wire_formats=None,
+                 lanes=None, single_flight=True):
         threading.Thread.__init__(self)
         self.address = address
         self.owner = owner
+        self.idle_timeout = idle_timeout
+        if wire_formats is None:
+            wire_formats = wire.default_formats
+        self.wire_formats = frozenset(wire_formats)
+        self.pool = WorkerPool(workers, queue_depth)
+        if lanes is None:
+            lanes = {CONTROL: 4}
+        self.lanes = make_lanes(lanes, queue_depth)
+        self.flights = SingleFlight() if single_flight else None
+        self.metrics = metrics.Registry()
         self.daemon = True
 
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.bind(address)
-        self.server.listen(1)
-        pass
+        self.server.listen(backlog)
+        self.unix_server = register_local(self, self.server.getsockname(),
+                                          backlog)
 
-    def run(self):
+    def _accept(self, server):
         while True:
             try:
-                conn, addr = self.server.accept()
-                req = Request(self.owner, conn, addr)
-                print "Serving a request from {0}".format(addr)
+                conn, addr = server.accept()
+                req = Request(self, conn, addr)
+                log.info('orb.accept', "Serving a request",
+                         peer=addr or 'unix')
                 req.start()
             except socket.error:
                 continue
-        pass
+
+    def run(self):
+        if self.unix_server is not None:
+            acceptor = threading.Thread(target=self._accept,
+                                        args=(self.unix_server,))
+            acceptor.daemon = True
+            acceptor.start()
+        self._accept(self.server)
+
+    def stats(self):
+        """Return the statistics of the served methods and the workers."""
+        return {'methods': self.metrics.snapshot(),
+                'workers': self.pool.stats(),
+                'lanes': dict((name, pool.stats())
+                              for name, pool in self.lanes.iteritems()),
+                'single_flight': self.flights and self.flights.stats()}
 
 
 class Peer:
     """ Peer class, this should be extended in order to build objects that
         communicate over the network.
+
+        `wire_format` is the format of the stubs the peer opens to other
+        peers, which its skeleton accepts as well, even if it is one of
+        wire.TRUSTED_ONLY; the name service is always called with JSON
+        lines, and its lookups are cached, see NameServiceCache.
+
+        Host names are looked up through default_resolver. With
+        `resolve_in_background` the name service host is looked up while
+        the skeleton is set up, and only waited for on the first call.
     """
 
-    def __init__(self, l_address, ns_address, ptype):
+    def __init__(self, l_address, ns_address, ptype, skeleton_class=Skeleton,
+                 wire_format=None, resolve_in_background=False):
         self.type = ptype
         self.hash = ""
         self.id = -1
+        self.wire_format = wire_format
+        if resolve_in_background:
+            default_resolver.prefetch(ns_address[0])
         self.address = self._get_external_interface(l_address)
-        self.skeleton = Skeleton(self, self.address)
-        self.name_service_address = self._get_external_interface(ns_address)
-        self.name_service = Stub(self.name_service_address)
+        wire_formats = list(wire.default_formats)
+        if wire_format in wire.codecs:
+            wire_formats.append(wire_format)
+        self.skeleton = skeleton_class(self, self.address,
+                                       wire_formats=wire_formats)
+        if resolve_in_background:
+            # The stub resolves the name on connect, from the prefetch.
+            self.name_service_address = tuple(ns_address)
+        else:
+            self.name_service_address = self._get_external_interface(
+                ns_address)
+        self.name_service = NameServiceCache(Stub(self.name_service_address))
 
     # Private methods
 
@@ -152,7 +1906,7 @@ class Peer:
         """
         addr_name = address[0]
         if addr_name != "":
-            addrs = socket.gethostbyname_ex(addr_name)[2]
+            addrs = default_resolver.addresses(addr_name)
             if len(addrs) == 0:
                 raise ComunicationError("Invalid address to listen to")
             elif len(addrs) == 1:
@@ -175,6 +1929,30 @@ class Peer:
         """Unregister the object before removal."""
         self.name_service.unregister(self.id, self.type, self.hash)
 
+    @control
+    @idempotent
     def check(self):
         """Checking to see if the object is still alive."""
         return (self.id, self.type)
+
+    def stats(self):
+        """ Return the call statistics of this peer.
+
+            Holds the counters and latency histograms of every method served
+            by the skeleton and of every method called through stubs, and
+            the figures of the worker and connection pools, the state of
+            the circuit breakers, the hits of the name service and host
+            name caches and the records of the logger.
+        """
+        return {'server': self.skeleton.stats(),
+                'client': client_metrics.snapshot(),
+                'connections': default_pool.stats(),
+                'breakers': default_breakers.stats(),
+                'name_service': self.name_service.stats(),
+                'resolver': default_resolver.stats(),
+                'log': log.default_logger.stats()}
+
+    def prometheus(self):
+        """Return the call statistics in the Prometheus text format."""
+        return ''.join((self.skeleton.metrics.prometheus('orb_server'),
+                        client_metrics.prometheus('orb_client')))
@@ -0,0 +1,148 @@
+# ------------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# ------------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 01 December 2012
+#
+# Copyright 2012 Linkoping University
+# ------------------------------------------------------------------------------
+
+""" Wire formats of the Object Request Broker
+
+    Every connection starts with newline terminated JSON messages, the
+    original format of the ORB. A stub may then offer a list of codecs with
+    a NEGOTIATE request:
+
+        {"method": "_orb_negotiate", "params": [["marshal", "json"]]}
+
+    A skeleton that knows one of them answers with the name of its choice,
+    and from then on both ends exchange length-prefixed frames: a 4-byte
+    big-endian length followed by the message encoded with the codec. Peers
+    that predate framing answer with an error and stay on JSON lines.
+
+    Codecs ::
+        json    ::  always available,
+        marshal ::  always available, only for trusted peers since
+                    malformed input can crash the interpreter,
+        msgpack ::  available when the msgpack package is installed.
+
+    Skeletons accept the codecs in default_formats unless told otherwise;
+    the ones in TRUSTED_ONLY must be enabled explicitly.
+"""
+
+import json
+import struct
+import marshal
+
+NEGOTIATE = "_orb_negotiate"
+
+HEADER = struct.Struct("!I")
+
+
+class Codec(object):
+    """A named pair of functions serializing messages to strings."""
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+codecs = {
+    'json': Codec('json', json.dumps, json.loads),
+    'marshal': Codec('marshal', lambda m: marshal.dumps(m, 2), marshal.loads),
+}
+
+try:
+    import msgpack
+    codecs['msgpack'] = Codec('msgpack', msgpack.packb, msgpack.unpackb)
+except ImportError:
+    pass
+
+# Codecs that are unsafe to accept from untrusted callers.
+TRUSTED_ONLY = frozenset(['marshal'])
+
+# Codecs accepted by skeletons by default.
+default_formats = [name for name in codecs if name not in TRUSTED_ONLY]
+
+
+class LineFraming(object):
+    """Newline terminated JSON messages."""
+
+    name = 'json-lines'
+
+    def __init__(self):
+        self.chunks = []
+
+    def encode(self, message):
+        return ''.join((json.dumps(message), '\n'))
+
+    def feed(self, data):
+        """Buffer received data and return the complete messages in it."""
+        messages = []
+        lines = data.split('\n')
+        for line in lines[:-1]:
+            self.chunks.append(line)
+            try:
+                messages.append(json.loads(''.join(self.chunks)))
+            except ValueError:
+                pass
+            self.chunks = []
+        if lines[-1]:
+            self.chunks.append(lines[-1])
+        return messages
+
+
+class FrameFraming(object):
+    """Length-prefixed frames holding messages encoded with a codec."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.name = codec.name
+        self.chunks = []
+        self.size = 0
+        self.needed = None
+
+    def encode(self, message):
+        payload = self.codec.dumps(message)
+        return ''.join((HEADER.pack(len(payload)), payload))
+
+    def feed(self, data):
+        """ Buffer received data and return the complete messages in it.
+
+            Raises ValueError if a frame cannot be decoded.
+        """
+        self.chunks.append(data)
+        self.size += len(data)
+        messages = []
+
+        while True:
+            if self.needed is None:
+                if self.size < HEADER.size:
+                    break
+                buf = ''.join(self.chunks)
+                self.chunks = [buf]
+                self.needed = HEADER.size + HEADER.unpack_from(buf)[0]
+            if self.size < self.needed:
+                break
+
+            buf = ''.join(self.chunks)
+            try:
+                messages.append(
+                    self.codec.loads(buf[HEADER.size:self.needed]))
+            except Exception, e:
+                raise ValueError("Bad {0} frame: {1}".format(self.name, e))
+            rest = buf[self.needed:]
+            self.chunks = [rest] if rest else []
+            self.size = len(rest)
+            self.needed = None
+
+        return messages
+
+
+def choose(offered, accepted):
+    """Return the first offered codec name that is accepted, or None."""
+    for name in offered:
+        if name in accepted and name in codecs:
+            return name
+    return None
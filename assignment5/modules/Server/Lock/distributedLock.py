@@ -11,10 +11,16 @@
 
 import time
 
+from Common import log
+from Common import orb
+
 NO_TOKEN = 0
 TOKEN_PRESENT = 1
 TOKEN_HELD = 2
 
+# Times a token request is sent again to a peer whose call failed.
+request_retries = 2
+
 
 class DistributedLock(object):
     """ Implementation of distributed mutual exclusion for a list of peers.
@@ -22,6 +28,13 @@ class DistributedLock(object):
         For simplicity, in this lock implementation we do not deal with cases
         where the peer holding the token dies without passing the token to
         someone else first.
+
+        The token protocol methods are in the control lane of the skeleton,
+        so that token passing is not queued behind data calls. The token is
+        passed with two-way calls: a one-way call can be dropped by a busy
+        skeleton, or run after the calls sent behind it. Passing the token
+        ignores the deadline of the call being served, and the token is
+        only given up once the other peer has it.
     """
 
     def __init__(self, owner, peer_list):
@@ -62,10 +75,16 @@ class DistributedLock(object):
     def destroy(self):
         """ The object is being destroyed. If we have the token, we must
             give it to someone else.
+
+            The last peer to leave takes the token with it, the next one to
+            join creates a new one.
         """
         if self.state in (TOKEN_HELD, TOKEN_PRESENT):
-            pid = self.peer_list.peers.values()[0]
-            self.peer_list.peer(pid).obtain_token()
+            pids = self.peer_list.peers.keys()
+            if pids:
+                with orb.no_deadline():
+                    self.peer_list.peer(pids[0]).obtain_token(self.token)
+            self.state = NO_TOKEN
 
     def register_peer(self, pid):
         """Called when a new peer joins the system."""
@@ -94,37 +113,71 @@ class DistributedLock(object):
             self.peer_list.lock.release()
 
     def acquire(self):
-        """Called when this object tries to acquire the lock."""
-        print "Trying to acquire the lock..."
-        self.peer_list.lock.acquire()
+        """ Called when this object tries to acquire the lock.
 
-        self.time += 1
+            Waits for the token no longer than the deadline of the call
+            being served, if any, and raises orb.DeadlineExceeded then.
+            The token request stays with the other peers, so the token
+            may still arrive later on.
 
-        try:
-            if self.state == NO_TOKEN:
-                for pid, peer in self.peer_list.peers.iteritems():
-                    peer.request_token(self.time, self.owner.id)
+            Raises orb.ComunicationError if the token request could not be
+            sent to some peer, which may be the one holding the token.
+        """
+        log.info('lock', "Trying to acquire the lock", peer=self.owner.id)
+        self.peer_list.lock.acquire()
 
-                self.peer_list.lock.release()
+        try:
+            self.time += 1
 
-                while self.state == NO_TOKEN:
-                    time.sleep(0.01)
+            if self.state == NO_TOKEN:
+                self._request_token()
             else:
                 self.token[self.owner.id] = self.time
-                self.peer_list.lock.release()
 
-            self.state = TOKEN_HELD
-
-        except Exception:
+        finally:
             self.peer_list.lock.release()
 
+        while self.state == NO_TOKEN:
+            if orb.remaining_time() == 0.0:
+                raise orb.DeadlineExceeded("The token did not arrive in time")
+            time.sleep(0.01)
+
+        self.state = TOKEN_HELD
+
+    def _request_token(self):
+        results = self.peer_list.broadcast('request_token', self.time,
+                                           self.owner.id)
+        failed = dict((pid, result) for pid, result in results.iteritems()
+                      if isinstance(result, Exception))
+
+        for _ in range(request_retries):
+            for pid in failed.keys():
+                if pid not in self.peer_list.peers:
+                    # The peer has left in the meantime.
+                    del failed[pid]
+                    continue
+                try:
+                    self.peer_list.peers[pid].request_token(self.time,
+                                                            self.owner.id)
+                    del failed[pid]
+                except Exception, e:
+                    failed[pid] = e
+
+        if failed:
+            raise orb.ComunicationError(
+                "Could not request the token from peers {0}: {1}".format(
+                    sorted(failed), failed.values()[0]))
+
     def _pass_token(self):
         def do_release():
             if self.request[pid] > self.token[pid]:
+                token = dict(self.token)
+                token[pid] = self.time
+                with orb.no_deadline():
+                    self.peer_list.peers[pid].obtain_token(token)
+                self.token = token
                 self.state = NO_TOKEN
-                self.token[pid] = self.time
                 self.time += 1
-                self.peer_list.peers[pid].obtain_token(self.token)
                 return True
 
         for pid in [p for p in self.peer_list.peers if p > self.owner.id]:
@@ -137,7 +190,7 @@ class DistributedLock(object):
 
     def release(self):
         """Called when this object releases the lock."""
-        print "Releasing the lock..."
+        log.info('lock', "Releasing the lock", peer=self.owner.id)
         assert self.state == TOKEN_HELD
 
         self.state = TOKEN_PRESENT
@@ -148,6 +201,7 @@ class DistributedLock(object):
         finally:
             self.peer_list.lock.release()
 
+    @orb.control
     def request_token(self, time, pid):
         """Called when some other object requests the token from us."""
         self.peer_list.lock.acquire()
@@ -162,9 +216,10 @@ class DistributedLock(object):
         finally:
             self.peer_list.lock.release()
 
+    @orb.control
     def obtain_token(self, token):
         """Called when some other object is giving us the token."""
-        print "Receiving the token..."
+        log.info('lock', "Receiving the token", peer=self.owner.id)
 
         token = {int(k): v for k, v in token.iteritems()}
         self.token = token
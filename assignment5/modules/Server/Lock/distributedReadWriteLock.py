@@ -29,11 +29,17 @@ class DistributedReadWriteLock(ReadWriteLock):
             to the rest of the peers.
         """
         super(DistributedReadWriteLock, self).write_acquire()
-        self.distributed_lock.acquire()
+        try:
+            self.distributed_lock.acquire()
+        except Exception:
+            super(DistributedReadWriteLock, self).write_release()
+            raise
 
     def write_release(self):
         """ Override the write_release method to include releasing access
             to the rest of the peers.
         """
-        self.distributed_lock.release()
-        super(DistributedReadWriteLock, self).write_release()
+        try:
+            self.distributed_lock.release()
+        finally:
+            super(DistributedReadWriteLock, self).write_release()
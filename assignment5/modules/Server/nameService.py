@@ -0,0 +1,155 @@
+# ------------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# ------------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 01 December 2012
+#
+# Copyright 2012 Linkoping University
+# ------------------------------------------------------------------------------
+
+"""Local implementation of the name service used by the labs."""
+
+import random
+import threading
+from Common import orb
+
+
+class NameService(object):
+    """ Name service speaking the protocol of the course name service.
+
+        Objects are kept in one index per type. Every index holds a list of
+        (id, address) entries and a map from id to the position of its
+        entry, so that require_object(), require_any() and unregister() are
+        O(1) and require_all() is O(k) in the number of objects of the type.
+
+        Remote interface ::
+            register(type, address)     -> [id, hash]
+            unregister(id, type, hash)
+            require_all(type)           -> [[id, address], ...]
+            require_any(type)           -> address
+            require_object(type, id)    -> address
+    """
+
+    def __init__(self, address, check_interval=None):
+        self.address = address
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.rand = random.Random()
+        self.rand.seed()
+        self.next_id = 0
+        self.entries = {}
+        self.positions = {}
+        self.hashes = {}
+        self.skeleton = orb.Skeleton(self, address)
+
+    # Private methods
+
+    def _remove(self, ptype, pid):
+        """Drop an object from the index of its type. Lock must be held."""
+        entries = self.entries[ptype]
+        positions = self.positions[ptype]
+        pos = positions.pop(pid)
+        last = entries.pop()
+        if last[0] != pid:
+            entries[pos] = last
+            positions[last[0]] = pos
+        if not entries:
+            del self.entries[ptype]
+            del self.positions[ptype]
+        del self.hashes[(ptype, pid)]
+
+    def _check_objects(self):
+        """Periodically drop the objects that no longer answer check()."""
+        while True:
+            threading.Event().wait(self.check_interval)
+            self.lock.acquire()
+            try:
+                objects = [(ptype, pid, addr)
+                           for ptype, entries in self.entries.iteritems()
+                           for pid, addr in entries]
+            finally:
+                self.lock.release()
+
+            futures = [(ptype, pid, orb.Stub(addr).async_call(
+                            'check', timeout=self.check_interval))
+                       for ptype, pid, addr in objects]
+            for ptype, pid, future in futures:
+                try:
+                    future.result()
+                except Exception:
+                    self.lock.acquire()
+                    try:
+                        if (ptype, pid) in self.hashes:
+                            self._remove(ptype, pid)
+                    finally:
+                        self.lock.release()
+
+    # Public methods
+
+    def start(self):
+        """Start serving requests."""
+        self.skeleton.start()
+        if self.check_interval:
+            checker = threading.Thread(target=self._check_objects)
+            checker.daemon = True
+            checker.start()
+
+    def register(self, ptype, address):
+        """Register an object and return its id and its secret hash."""
+        self.lock.acquire()
+        try:
+            pid = self.next_id
+            self.next_id += 1
+            phash = "{0:032x}".format(self.rand.getrandbits(128))
+            entries = self.entries.setdefault(ptype, [])
+            self.positions.setdefault(ptype, {})[pid] = len(entries)
+            entries.append((pid, address))
+            self.hashes[(ptype, pid)] = phash
+            return pid, phash
+        finally:
+            self.lock.release()
+
+    def unregister(self, pid, ptype, phash):
+        """Unregister an object, given the hash it got from register()."""
+        self.lock.acquire()
+        try:
+            if self.hashes.get((ptype, pid)) != phash:
+                raise Exception(
+                    "No object of type '{0}' with id {1} and the given hash"
+                    .format(ptype, pid))
+            self._remove(ptype, pid)
+        finally:
+            self.lock.release()
+
+    @orb.idempotent
+    def require_all(self, ptype):
+        """Return the [id, address] pairs of all objects of a type."""
+        self.lock.acquire()
+        try:
+            return list(self.entries.get(ptype, ()))
+        finally:
+            self.lock.release()
+
+    def require_any(self, ptype):
+        """Return the address of a random object of a type."""
+        self.lock.acquire()
+        try:
+            if ptype not in self.entries:
+                raise Exception("No object of type '{0}'".format(ptype))
+            return self.rand.choice(self.entries[ptype])[1]
+        finally:
+            self.lock.release()
+
+    @orb.idempotent
+    def require_object(self, ptype, pid):
+        """Return the address of the object of a type with the given id."""
+        self.lock.acquire()
+        try:
+            try:
+                pos = self.positions[ptype][pid]
+            except KeyError:
+                raise Exception(
+                    "No object of type '{0}' with id {1}".format(ptype, pid))
+            return self.entries[ptype][pos][1]
+        finally:
+            self.lock.release()
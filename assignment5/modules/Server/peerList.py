@@ -12,6 +12,9 @@
 import threading
 from Common import orb
 
+# Seconds to wait for the other peers to unregister a leaving one.
+unregister_timeout = 10.0
+
 
 class PeerList(object):
     """Class that builds a list of objects of the same type as this one."""
@@ -39,28 +42,37 @@ class PeerList(object):
                 if pid < self.owner.id:
                     self.register_peer(pid, paddr)
 
-            for _, peer in self.peers.iteritems():
-                peer.register_peer(self.owner.id, self.owner.address)
+            self.broadcast('register_peer', self.owner.id, self.owner.address)
 
         finally:
             self.lock.release()
 
     def destroy(self):
-        """Unregister this peer from all others in the list."""
+        """ Unregister this peer from all others in the list.
+
+            Peers that fail to unregister it, or do not answer within
+            `unregister_timeout` seconds, are reported.
+        """
         self.lock.acquire()
         try:
-            for pid in self.peers:
-                self.peer(pid).unregister_peer(self.owner.id)
+            results = self.broadcast('unregister_peer', self.owner.id,
+                                     timeout=unregister_timeout)
         finally:
             self.lock.release()
 
+        for pid, result in sorted(results.items()):
+            if isinstance(result, Exception):
+                print "Peer {0} could not unregister us: {1}".format(pid,
+                                                                     result)
+
     def register_peer(self, pid, paddr):
         """Register a new peer joining the network."""
         # Synchronize access to the peer list as several peers might call
         # this method in parallel.
         self.lock.acquire()
         try:
-            self.peers[pid] = orb.Stub(paddr)
+            self.peers[pid] = orb.Stub(paddr,
+                                       wire_format=self.owner.wire_format)
             print "Peer {0} has joined the system.".format(pid)
         finally:
             self.lock.release()
@@ -78,6 +90,54 @@ class PeerList(object):
         finally:
             self.lock.release()
 
+    def broadcast(self, method, *args, **kwargs):
+        """ Call a method with the given arguments on all peers in parallel.
+
+            Returns a dictionary mapping each peer id to the result of its
+            call or to the exception it raised. Peers that have not answered
+            within the optional `timeout` (in seconds) are mapped to a
+            ComunicationError and count as failures for their circuit
+            breaker. With `oneway` set the calls are only sent, and
+            every peer the call was sent to is mapped to None.
+        """
+        timeout = kwargs.pop('timeout', None)
+        oneway = kwargs.pop('oneway', False)
+
+        self.lock.acquire()
+        try:
+            peers = self.peers.items()
+        finally:
+            self.lock.release()
+
+        results = {}
+
+        if oneway:
+            for pid, peer in peers:
+                try:
+                    results[pid] = getattr(peer.oneway, method)(*args)
+                except Exception, e:
+                    results[pid] = e
+            return results
+
+        futures = {}
+        for pid, peer in peers:
+            futures[pid] = peer.async_call(method, *args)
+        orb.wait_all(futures.values(), timeout)
+
+        for pid, peer in peers:
+            future = futures[pid]
+            if future.done():
+                try:
+                    results[pid] = future.result()
+                except Exception, e:
+                    results[pid] = e
+            else:
+                peer.breakers.record(peer.address, False)
+                results[pid] = orb.ComunicationError(
+                    "Peer {0} did not answer '{1}' in time".format(pid, method))
+        return results
+
+    @orb.idempotent
     def display_peers(self):
         """Display all the peers in the list."""
         self.lock.acquire()